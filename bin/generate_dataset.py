@@ -4,46 +4,90 @@
 Created on Fri Dec  6 14:14:31 2019
 
 @author: alienor
+
+Generates a dataset of virtual scans in a database. Each item runs a
+VirtualScan task in its own `romi_run_task` process; several items are run
+at once by a pool of workers. As a database is locked by the process using
+it, each item is generated in its own temporary database, next to the
+database, which links to its other scans (e.g. the virtual scan data), and
+the finished scan is then moved to the database. Finished items are recorded
+in a manifest in the database directory so that a rerun skips them, and the
+items can be split in shards to run the generation on several machines.
+
+usage: generate_dataset.py [-h] [--workers N] [--shard-index I]
+                           [--shard-count C] [--n-plants K] [--seed S]
+                           db config
 """
-import numpy as np
+import argparse
+import copy
+import json
 import os
 import random
-import toml
-import copy
-from romidata import fsdb, io
-import tempfile
+import shutil
 import subprocess
-import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import toml
 
-random.seed(0.1423432)
+MANIFEST = "generate_dataset_manifest.jsonl"
+MARKER_FILE = "romidb"
 
-param = sys.argv[-1]
-db = sys.argv[-2]
 
-def run(config, scan_name):
+def run(config, db, scan_name):
     with tempfile.TemporaryDirectory() as tempdir:
         toml.dump(config, open(os.path.join(tempdir, "config.toml"), "w"))
         subprocess.run(["romi_run_task", "--config", os.path.join(tempdir, "config.toml"), "VirtualScan", os.path.join(db, scan_name), "--local-scheduler", "--log-level", "WARNING"], check=True)
 
-def basic_scan_config(config):
+def item_db(db, exclude):
+    """Temporary database next to db, with links to the scans of db which
+    are not in exclude"""
+    db = os.path.abspath(db)
+    tmp_db = tempfile.mkdtemp(prefix=".generate_dataset-", dir=os.path.dirname(db))
+    open(os.path.join(tmp_db, MARKER_FILE), "w").close()
+    for name in os.listdir(db):
+        if name in exclude or not os.path.isdir(os.path.join(db, name)):
+            continue
+        os.symlink(os.path.join(db, name), os.path.join(tmp_db, name))
+    return tmp_db
+
+def run_in_item_db(config, db, scan_name, exclude):
+    """Runs the item in a temporary database, then moves the scan to db.
+    Nothing is left in db if the item fails."""
+    tmp_db = item_db(db, exclude)
+    try:
+        run(config, tmp_db, scan_name)
+        target = os.path.join(db, scan_name)
+        if os.path.exists(target):
+            # Partial scan of an interrupted run
+            shutil.rmtree(target)
+        os.rename(os.path.join(tmp_db, scan_name), target)
+    finally:
+        shutil.rmtree(tmp_db, ignore_errors=True)
+
+def basic_scan_config(config, rng):
     config = copy.deepcopy(config)
-    config["ScanPath"]["kwargs"]["center_x"] = random.randint(-5, 5)
-    config["ScanPath"]["kwargs"]["center_y"] = random.randint(-5, 5)
+    config["ScanPath"]["kwargs"]["center_x"] = rng.randint(-5, 5)
+    config["ScanPath"]["kwargs"]["center_y"] = rng.randint(-5, 5)
 
-    angle = random.randint(0, 30)
+    angle = rng.randint(0, 30)
     distance = 30
     radius = distance
 
     config["ScanPath"]["kwargs"]["tilt"] = angle
     config["ScanPath"]["kwargs"]["radius"] = radius
-    config["ScanPath"]["kwargs"]["z"] = float(distance * np.sin(angle / 180 * np.pi)) + random.randint(25, 40)
+    config["ScanPath"]["kwargs"]["z"] = float(distance * np.sin(angle / 180 * np.pi)) + rng.randint(25, 40)
 
-    focal = np.random.randint(20, 35)
+    focal = rng.randint(20, 34)
     config["VirtualScan"]["scanner"]["focal"] = focal
-    config["VirtualPlant"]["lpy_globals"]["BETA"] = random.randint(50, 90)
-    config["VirtualPlant"]["lpy_globals"]["INTERNODE_LENGTH"] = 0.1 * random.randint(11, 15)
-    config["VirtualPlant"]["lpy_globals"]["STEM_DIAMETER"] = 0.01 * random.randint(9, 20)
-    config["VirtualPlant"]["lpy_globals"]["BETA"] = random.randint(50, 90)
+    config["VirtualPlant"]["lpy_globals"]["BETA"] = rng.randint(50, 90)
+    config["VirtualPlant"]["lpy_globals"]["INTERNODE_LENGTH"] = 0.1 * rng.randint(11, 15)
+    config["VirtualPlant"]["lpy_globals"]["STEM_DIAMETER"] = 0.01 * rng.randint(9, 20)
+    config["VirtualPlant"]["lpy_globals"]["SEED"] = rng.randint(0, 100000)
+    # Seeds the renderer and the object and background choices of VirtualScan
+    config["VirtualScan"]["scanner"]["seed"] = rng.randint(0, 100000)
     return config
 
 def no_scene(config):
@@ -77,25 +121,95 @@ def arabidopsis_big(config):
 
     return config
 
-orig_config = toml.load(param)
-k = 20
-
-config = basic_scan_config(orig_config)
-config_no_scene = no_scene(config)
-config_no_leaves = no_leaves(config_no_scene)
-config_branch_on = branch_on(config_no_scene)
-config_big_branch_on = arabidopsis_big(config_branch_on)
-config_big = arabidopsis_big(config_no_scene)
-config_big_scene = arabidopsis_big(config)
-
-configs = [config,
-config_no_leaves,
-config_no_scene,
-config_branch_on,
-config_big_branch_on,
-config_big,
-config_big_scene]
-
-for i in range(k):
-    for j,c in enumerate(configs):
-        run(c, "%06d"%(i*len(configs) + j))
+def variants(config):
+    config_no_scene = no_scene(config)
+    config_no_leaves = no_leaves(config_no_scene)
+    config_branch_on = branch_on(config_no_scene)
+    config_big_branch_on = arabidopsis_big(config_branch_on)
+    config_big = arabidopsis_big(config_no_scene)
+    config_big_scene = arabidopsis_big(config)
+
+    return [config,
+    config_no_leaves,
+    config_no_scene,
+    config_branch_on,
+    config_big_branch_on,
+    config_big,
+    config_big_scene]
+
+def dataset_items(orig_config, k, seed):
+    """Lists the (scan name, config) items of the dataset. The random
+    parameters of block i only depend on the seed and on i, so that the
+    dataset does not depend on the order in which items are run."""
+    items = []
+    for i in range(k):
+        rng = random.Random("%s-%i"%(seed, i))
+        configs = variants(basic_scan_config(orig_config, rng))
+        for j, c in enumerate(configs):
+            items.append(("%06d"%(i*len(configs) + j), c))
+    return items
+
+def read_manifest(db):
+    done = set()
+    fname = os.path.join(db, MANIFEST)
+    if os.path.exists(fname):
+        with open(fname) as f:
+            for line in f:
+                line = line.strip()
+                if line != "":
+                    done.add(json.loads(line)["scan"])
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a dataset of virtual scans.')
+    parser.add_argument('db', help='database location')
+    parser.add_argument('config', help='base TOML configuration')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of scans run at once')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='index of the shard run by this process')
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help='number of shards the dataset is split into')
+    parser.add_argument('--n-plants', type=int, default=20,
+                        help='number of plants, each is scanned with every variant')
+    parser.add_argument('--seed', default="0.1423432",
+                        help='seed of the dataset random parameters')
+    args = parser.parse_args()
+
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error("shard index must be in [0, shard count)")
+
+    orig_config = toml.load(args.config)
+    items = dataset_items(orig_config, args.n_plants, args.seed)
+    item_names = set(name for name, _ in items)
+    items = items[args.shard_index::args.shard_count]
+
+    done = read_manifest(args.db)
+    todo = [(name, c) for name, c in items if name not in done]
+    print("%i items in shard, %i already done"%(len(items), len(items) - len(todo)))
+
+    lock = threading.Lock()
+    def run_item(item):
+        name, config = item
+        run_in_item_db(config, args.db, name, item_names)
+        with lock:
+            with open(os.path.join(args.db, MANIFEST), "a") as f:
+                f.write(json.dumps({"scan": name}) + "\n")
+        return name
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_item, item): item[0] for item in todo}
+        for future, name in futures.items():
+            try:
+                future.result()
+                print("done: %s"%name)
+            except Exception as e:
+                print("failed: %s (%s)"%(name, e))
+                failed.append(name)
+
+    if len(failed) > 0:
+        raise SystemExit("%i items failed, rerun to retry them"%len(failed))
+
+if __name__ == "__main__":
+    main()
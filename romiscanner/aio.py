@@ -0,0 +1,409 @@
+"""
+
+    romiscanner - Python tools for the ROMI 3D Scanner
+
+    Copyright (C) 2018 Sony Computer Science Laboratories
+    Authors: D. Colliaux, T. Wintz, P. Hanappe
+
+    This file is part of romiscanner.
+
+    romiscanner is free software: you can redistribute it
+    and/or modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    romiscanner is distributed in the hope that it will be
+    useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+    See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with romiscanner.  If not, see
+    <https://www.gnu.org/licenses/>.
+
+"""
+import asyncio
+import functools
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Set, Tuple
+
+from romidata.db import Fileset
+
+from . import path
+from .hal import DataItem, ScanCheckpoint, completed_shots, write_data_item
+from .log import logger
+from .scanner import Scanner
+from .units import *
+
+
+class AsyncCNC(metaclass=ABCMeta):
+    @abstractmethod
+    async def home(self) -> None:
+        pass
+
+    def is_homed(self) -> bool:
+        return False
+
+    @abstractmethod
+    async def get_position(self) -> Tuple[Length_mm, Length_mm, Length_mm]:
+        pass
+
+    @abstractmethod
+    async def moveto(self, x: Length_mm, y: Length_mm, z: Length_mm) -> None:
+        """Returns when the position is reached"""
+        pass
+
+    def arc_enabled(self) -> bool:
+        return False
+
+    async def arcto(self, x: Length_mm, y: Length_mm, z: Length_mm, arc: path.Arc, feed: float) -> None:
+        """Moves along an arc, returns when the position is reached"""
+        raise NotImplementedError
+
+
+class AsyncGimbal(metaclass=ABCMeta):
+    @abstractmethod
+    async def get_position(self) -> Tuple[Deg, Deg]:
+        pass
+
+    @abstractmethod
+    async def moveto(self, pan: Deg, tilt: Deg) -> None:
+        """Returns when the position is reached"""
+        pass
+
+
+class AsyncCamera(metaclass=ABCMeta):
+    @abstractmethod
+    async def trigger(self, idx: int, metadata: dict=None):
+        """Captures a shot, returns the handle to fetch it"""
+        pass
+
+    @abstractmethod
+    async def fetch(self, handle) -> DataItem:
+        """Transfers the data item of a shot captured by trigger"""
+        pass
+
+    @abstractmethod
+    def channels(self) -> List[str]:
+        pass
+
+    async def retrieve(self) -> List[DataItem]:
+        return []
+
+
+class AbstractAsyncScanner(metaclass=ABCMeta):
+    """
+    Scanner whose scan loop runs the steps of consecutive shots as
+    concurrent tasks: the transfer and the write of a shot run while the
+    scanner moves to the next pose and settles. The only ordering
+    constraints are that a move starts once the previous capture is done,
+    that a shot is fetched once it is captured, and that it is written once
+    it is fetched. Writes are run one at a time in their own thread, each
+    followed by the update of the scan checkpoint, so that interrupted scans
+    can be resumed as with ``AbstractScanner.scan``.
+    """
+    def __init__(self):
+        self.scan_count = 0
+        self.ext = 'jpg'
+        self.write_executor = ThreadPoolExecutor(max_workers=1)
+
+    @abstractmethod
+    async def get_position(self) -> path.Pose:
+        pass
+
+    @abstractmethod
+    async def set_position(self, pose: path.Pose) -> None:
+        pass
+
+    @abstractmethod
+    async def trigger(self, idx: int, metadata: dict):
+        pass
+
+    @abstractmethod
+    async def fetch(self, handle) -> DataItem:
+        pass
+
+    @abstractmethod
+    def channels(self) -> List[str]:
+        pass
+
+    async def retrieve(self) -> List[DataItem]:
+        return []
+
+    async def home(self) -> None:
+        """Brings the scanner to a known state before resuming a scan"""
+        pass
+
+    async def grab(self, idx: int, metadata: dict=None) -> DataItem:
+        return await self.fetch(await self.trigger(idx, metadata))
+
+    async def set_position_arc(self, pose: path.Pose, arc: path.Arc) -> None:
+        """Moves to the pose along an arc, by default in a straight line"""
+        await self.set_position(pose)
+
+    def inc_count(self) -> int:
+        x = self.scan_count
+        self.scan_count += 1
+        return x
+
+    async def get_target_pose(self, x: path.PathElement) -> path.Pose:
+        pos = await self.get_position()
+        target_pose = path.Pose()
+        for attr in pos.attributes():
+            if getattr(x, attr) is None:
+                setattr(target_pose, attr, getattr(pos, attr))
+            else:
+                setattr(target_pose, attr, getattr(x, attr))
+        return target_pose
+
+    def pose_metadata(self, pose: path.Pose, exact_pose: bool=True, metadata: dict={}) -> dict:
+        if exact_pose:
+            return {**metadata, "pose": [pose.x,pose.y,pose.z,pose.pan,pose.tilt]}
+        return {**metadata, "approximate_pose": [pose.x,pose.y,pose.z,pose.pan,pose.tilt]}
+
+    async def move_to(self, pose: path.Pose, arc: path.Arc=None) -> None:
+        if arc is not None:
+            await self.set_position_arc(pose, arc)
+        else:
+            await self.set_position(pose)
+
+    async def scan_at(self, pose: path.Pose, exact_pose: bool=True, metadata: dict={},
+                      arc: path.Arc=None) -> DataItem:
+        metadata = self.pose_metadata(pose, exact_pose, metadata)
+        await self.move_to(pose, arc)
+        return await self.grab(self.inc_count(), metadata=metadata)
+
+    def completed_shots(self, path: path.Path, fileset: Fileset) -> Set[int]:
+        """See ``AbstractScanner.completed_shots``"""
+        completed, start_count = completed_shots(path, fileset, self.channels())
+        if start_count is not None:
+            self.scan_count = start_count
+        return completed
+
+    def _write(self, data_item: DataItem, fileset: Fileset, checkpoint: ScanCheckpoint) -> None:
+        write_data_item(data_item, self.channels(), self.ext, fileset)
+        checkpoint.written(data_item.idx, self.scan_count)
+
+    async def write_data_item(self, data_item: DataItem, fileset: Fileset,
+                              checkpoint: ScanCheckpoint) -> None:
+        if len(data_item.channels) == 0: # Transfer deferred to retrieve
+            return
+        await asyncio.get_event_loop().run_in_executor(self.write_executor,
+            self._write, data_item, fileset, checkpoint)
+
+    async def write_fetched(self, fetch: asyncio.Future, fileset: Fileset,
+                            checkpoint: ScanCheckpoint) -> None:
+        await self.write_data_item(await fetch, fileset, checkpoint)
+
+    async def scan(self, path: path.Path, fileset: Fileset, resume: bool=False) -> None:
+        """
+        Scans along the path and writes the shots in the fileset, with the
+        checkpoints and the resume of ``AbstractScanner.scan``.
+        """
+        loop = asyncio.get_event_loop()
+        completed = set()
+        if resume:
+            completed = await loop.run_in_executor(self.write_executor,
+                self.completed_shots, path, fileset)
+            await self.home()
+        checkpoint = await loop.run_in_executor(self.write_executor,
+            ScanCheckpoint, fileset, len(path), self.scan_count, len(completed))
+        fetches = []
+        writes = []
+        try:
+            last = -1 if len(completed) == 0 else None
+            for i, x in enumerate(path):
+                if i in completed:
+                    self.inc_count() # shot ids stay the indices in the path
+                    continue
+                pose = await self.get_target_pose(x)
+                logger.debug(pose)
+                # Arcs start from the previous pose of the path
+                await self.move_to(pose, x.arc if last == i - 1 else None)
+                last = i
+                handle = await self.trigger(self.inc_count(),
+                                            self.pose_metadata(pose, x.exact_pose))
+                fetches.append(asyncio.ensure_future(self.fetch(handle)))
+                writes.append(asyncio.ensure_future(
+                    self.write_fetched(fetches[-1], fileset, checkpoint)))
+            if len(fetches) > 0: # Deferred transfers follow the fetches
+                await asyncio.wait(fetches)
+            for data_item in await self.retrieve():
+                writes.append(asyncio.ensure_future(self.write_data_item(data_item, fileset, checkpoint)))
+        finally:
+            results = await asyncio.gather(*writes, return_exceptions=True)
+        for res in results:
+            if isinstance(res, BaseException):
+                raise res
+        await loop.run_in_executor(self.write_executor, checkpoint.finish)
+
+
+class AsyncScanner(AbstractAsyncScanner):
+    """
+    Moves the CNC and the gimbal at the same time, then waits for the
+    stabilization of the scanner before grabbing. Arcs are followed at the
+    feed rate (mm/min) if it is given and the CNC supports them.
+    """
+    def __init__(self, cnc: AsyncCNC, gimbal: AsyncGimbal, camera: AsyncCamera,
+                 waiting_time: float=1., feed: float=None):
+        super().__init__()
+        self.cnc = cnc
+        self.gimbal = gimbal
+        self.camera = camera
+        self.waiting_time = waiting_time
+        self.feed = feed
+
+    async def home(self) -> None:
+        if not self.cnc.is_homed():
+            await self.cnc.home()
+
+    async def get_position(self) -> path.Pose:
+        (x, y, z), (pan, tilt) = await asyncio.gather(self.cnc.get_position(),
+                                                      self.gimbal.get_position())
+        return path.Pose(x, y, z, pan, tilt)
+
+    async def set_position(self, pose: path.Pose) -> None:
+        await asyncio.gather(self.cnc.moveto(pose.x, pose.y, pose.z),
+                             self.gimbal.moveto(pose.pan, pose.tilt))
+        await asyncio.sleep(self.waiting_time)
+
+    async def set_position_arc(self, pose: path.Pose, arc: path.Arc) -> None:
+        if self.feed is None or not self.cnc.arc_enabled():
+            await self.set_position(pose)
+            return
+        await asyncio.gather(self.cnc.arcto(pose.x, pose.y, pose.z, arc, self.feed),
+                             self.gimbal.moveto(pose.pan, pose.tilt))
+        await asyncio.sleep(self.waiting_time)
+
+    async def trigger(self, idx: int, metadata: dict=None):
+        return await self.camera.trigger(idx, metadata)
+
+    async def fetch(self, handle) -> DataItem:
+        return await self.camera.fetch(handle)
+
+    def channels(self) -> List[str]:
+        return self.camera.channels()
+
+    async def retrieve(self) -> List[DataItem]:
+        return await self.camera.retrieve()
+
+
+class ExecutorAdapter():
+    """
+    Runs the methods of a blocking driver in a thread of its own, so that
+    the calls to a device are serialized but do not block the event loop.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def call(self, method, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(self.executor,
+            functools.partial(getattr(self.device, method), *args, **kwargs))
+
+
+class CNCAdapter(ExecutorAdapter, AsyncCNC):
+    async def home(self) -> None:
+        await self.call("home")
+
+    def is_homed(self) -> bool:
+        return self.device.is_homed()
+
+    async def get_position(self) -> Tuple[Length_mm, Length_mm, Length_mm]:
+        return await self.call("get_position")
+
+    async def moveto(self, x: Length_mm, y: Length_mm, z: Length_mm) -> None:
+        await self.call("moveto", x, y, z)
+
+    def arc_enabled(self) -> bool:
+        return self.device.arc_enabled()
+
+    async def arcto(self, x: Length_mm, y: Length_mm, z: Length_mm, arc: path.Arc, feed: float) -> None:
+        await self.call("arcto_async", x, y, z, arc, feed)
+        await self.call("wait")
+
+
+class GimbalAdapter(ExecutorAdapter, AsyncGimbal):
+    """
+    If given, gimbal_pan maps the pan angles of the poses to the angles sent
+    to the gimbal, e.g. ``Scanner.gimbal_pan`` to unwrap them. It runs in
+    the thread of the gimbal.
+    """
+    def __init__(self, device, gimbal_pan=None):
+        super().__init__(device)
+        self.gimbal_pan = gimbal_pan
+
+    async def get_position(self) -> Tuple[Deg, Deg]:
+        return await self.call("get_position")
+
+    async def moveto(self, pan: Deg, tilt: Deg) -> None:
+        def moveto():
+            p = pan if self.gimbal_pan is None else self.gimbal_pan(pan)
+            self.device.moveto(p, tilt)
+        await asyncio.get_event_loop().run_in_executor(self.executor, moveto)
+
+
+class CameraAdapter(ExecutorAdapter, AsyncCamera):
+    """Adapter for an AbstractCamera, or any object with the trigger, fetch,
+    channels and retrieve methods of a camera"""
+    async def trigger(self, idx: int, metadata: dict=None):
+        return await self.call("trigger", idx, metadata)
+
+    async def fetch(self, handle) -> DataItem:
+        return await self.call("fetch", handle)
+
+    def channels(self) -> List[str]:
+        return self.device.channels()
+
+    async def retrieve(self) -> List[DataItem]:
+        return await self.call("retrieve")
+
+
+class ScannerAdapter(AbstractAsyncScanner):
+    """Runs the positioning and grabs of a blocking scanner in a thread, so
+    that writes overlap with the next shot"""
+    def __init__(self, scanner):
+        super().__init__()
+        self.scanner = ExecutorAdapter(scanner)
+        self.ext = scanner.ext
+
+    async def get_position(self) -> path.Pose:
+        return await self.scanner.call("get_position")
+
+    async def set_position(self, pose: path.Pose) -> None:
+        await self.scanner.call("set_position", pose)
+
+    async def set_position_arc(self, pose: path.Pose, arc: path.Arc) -> None:
+        await self.scanner.call("set_position_arc", pose, arc)
+
+    async def trigger(self, idx: int, metadata: dict=None):
+        return await self.scanner.call("trigger", idx, metadata)
+
+    async def fetch(self, handle) -> DataItem:
+        return await self.scanner.call("fetch", handle)
+
+    async def home(self) -> None:
+        await self.scanner.call("home")
+
+    def channels(self) -> List[str]:
+        return self.scanner.device.channels()
+
+    async def retrieve(self) -> List[DataItem]:
+        return await self.scanner.call("retrieve")
+
+
+def from_scanner(scanner) -> AbstractAsyncScanner:
+    """
+    Asynchronous scanner driving the devices of a blocking scanner: the CNC
+    and the gimbal of a Scanner are moved concurrently, with the pan
+    unwrapping, pan limits and arc moves of the Scanner. Other scanners are
+    run in a thread.
+    """
+    if isinstance(scanner, Scanner):
+        x = AsyncScanner(CNCAdapter(scanner.cnc),
+                         GimbalAdapter(scanner.gimbal, gimbal_pan=scanner.gimbal_pan),
+                         CameraAdapter(scanner), scanner.waiting_time, feed=scanner.feed)
+        x.ext = scanner.ext
+        return x
+    return ScannerAdapter(scanner)
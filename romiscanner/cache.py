@@ -0,0 +1,213 @@
+"""
+
+    romiscanner - Python tools for the ROMI 3D Scanner
+
+    Copyright (C) 2018 Sony Computer Science Laboratories
+    Authors: D. Colliaux, T. Wintz, P. Hanappe
+
+    This file is part of romiscanner.
+
+    romiscanner is free software: you can redistribute it
+    and/or modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    romiscanner is distributed in the hope that it will be
+    useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+    See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with romiscanner.  If not, see
+    <https://www.gnu.org/licenses/>.
+
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, Optional, Tuple
+
+from romidata import io
+from romidata.db import Fileset
+
+from .log import logger
+
+
+CONTENT_HASH_FILE = ".content_hash"
+
+
+def default_cache_dir() -> str:
+    """Cache location, $ROMISCANNER_CACHE or ~/.cache/romiscanner"""
+    return os.environ.get("ROMISCANNER_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "romiscanner"))
+
+
+def fileset_hash(fileset: Fileset) -> str:
+    """Hash of the names and contents of the files of a fileset"""
+    h = hashlib.sha256()
+    for f in sorted(fileset.get_files(), key=lambda f: f.id):
+        h.update(f.filename.encode())
+        h.update(hashlib.sha256(f.read_raw()).digest())
+    return h.hexdigest()
+
+
+def file_identity(f) -> list:
+    """
+    Cheap identity of a file: its id and name, with its size and
+    modification time if it is a local file, or the hash of its contents
+    otherwise.
+    """
+    try:
+        st = os.stat(f.path())
+        return [f.id, f.filename, st.st_size, st.st_mtime_ns]
+    except (AttributeError, TypeError, OSError):
+        return [f.id, f.filename, hashlib.sha256(f.read_raw()).hexdigest()]
+
+
+def fileset_key(fileset: Fileset) -> str:
+    """Hash of the identities of the files of a fileset"""
+    identities = [file_identity(f) for f in sorted(fileset.get_files(), key=lambda f: f.id)]
+    return hashlib.sha256(json.dumps(identities).encode()).hexdigest()
+
+
+class SceneCache():
+    """
+    On disk cache of extracted filesets, keyed by the identity of their
+    files (see ``file_identity``), so that a hit does not read the files.
+    The content hash of the fileset is stored with the entry, and checked
+    on a hit with verify.
+
+    An entry is extracted in a temporary directory and renamed in place once
+    complete, so concurrent tasks never see a partial entry: if two tasks
+    extract the same fileset, the first rename wins and the other copy is
+    discarded.
+
+    A cache hit saves the extraction only: a virtual scanner launched by a
+    task still opens the scene in its own Blender process. The scene is only
+    kept open across tasks by a virtual scanner server given by its host
+    (see ``VirtualScanner.load_scene``).
+    """
+    def __init__(self, cache_dir: str=None):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = os.path.join(cache_dir, "scenes")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, fileset: Fileset, verify: bool=False) -> str:
+        """
+        Returns the directory where the files of the fileset are extracted.
+        With verify, the contents of the fileset are hashed and a cached
+        entry whose hash differs is extracted again.
+        """
+        key = fileset_key(fileset)
+        target = os.path.join(self.cache_dir, key)
+        if os.path.isdir(target):
+            if not verify or self.content_hash(target) == fileset_hash(fileset):
+                logger.debug("scene cache hit: %s"%key)
+                return target
+            logger.warning("scene cache entry %s does not match its fileset"%key)
+            shutil.rmtree(target, ignore_errors=True)
+
+        logger.debug("scene cache miss: %s"%key)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            for f in fileset.get_files():
+                io.to_file(f, os.path.join(tmp, f.filename))
+            with open(os.path.join(tmp, CONTENT_HASH_FILE), "w") as f:
+                f.write(fileset_hash(fileset))
+            os.rename(tmp, target)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(target):
+                raise
+        return target
+
+    def content_hash(self, entry: str) -> Optional[str]:
+        try:
+            with open(os.path.join(entry, CONTENT_HASH_FILE)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+
+class RenderCache():
+    """
+    Size bounded on disk cache of rendered shots. Each entry holds the
+    encoded images of the channels of a shot and its metadata, under the
+    hash of the render state (see ``VirtualScanner.render_state``). The
+    least recently used entries are evicted when the cache exceeds its
+    maximum size.
+    """
+    def __init__(self, cache_dir: str=None, max_size: int=10*1024**3):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = os.path.join(cache_dir, "renders")
+        self.max_size = max_size
+        self.size = None # computed on the first write
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, state: dict) -> str:
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, bytes], dict]]:
+        """Returns the images and metadata of an entry, None if not cached"""
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry, "metadata.json")) as f:
+                content = json.load(f)
+            images = {}
+            for c, fname in content["images"].items():
+                with open(os.path.join(entry, fname), "rb") as f:
+                    images[c] = f.read()
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            return None
+        logger.debug("render cache hit: %s"%key)
+        return images, content["metadata"]
+
+    def put(self, key: str, images: Dict[str, bytes], metadata: dict) -> None:
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        content = {"images": {}, "metadata": metadata}
+        size = 0
+        for i, (c, data) in enumerate(images.items()):
+            fname = "%03d.png"%i
+            with open(os.path.join(tmp, fname), "wb") as f:
+                f.write(data)
+            size += len(data)
+            content["images"][c] = fname
+        with open(os.path.join(tmp, "metadata.json"), "w") as f:
+            json.dump(content, f)
+        try:
+            os.rename(tmp, os.path.join(self.cache_dir, key))
+        except OSError: # Already cached by a concurrent task
+            shutil.rmtree(tmp, ignore_errors=True)
+        if self.size is None:
+            self.evict()
+        else:
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if key.startswith(".tmp-"):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                mtime = os.path.getmtime(entry)
+            except OSError: # Not a directory, or evicted by a concurrent task
+                continue
+            entries.append((mtime, size, entry))
+            total += size
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self.size = total
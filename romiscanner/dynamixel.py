@@ -32,10 +32,17 @@ import atexit
 STEPS_PER_TURN = 4096
 
 class Gimbal(hal.AbstractGimbal):
+    """
+    Dynamixel XL430 pan/tilt gimbal. In position mode, the pan motor covers
+    a single turn and pan angles are taken modulo 360. With
+    extended_position, the pan motor uses the multi-turn mode, so that
+    unwrapped pan angles are followed without full turns back.
+    """
     def __init__(self,
         dev: str = "/dev/ttyUSB1",
         baud_rate: int=1000000,
-        pan_id: int=1, tilt_id: int=2, pan0: int=0, tilt0: int=1024):
+        pan_id: int=1, tilt_id: int=2, pan0: int=0, tilt0: int=1024,
+        extended_position: bool=False):
 
         self.baud_rate = baud_rate
         self.dev = dev
@@ -45,6 +52,7 @@ class Gimbal(hal.AbstractGimbal):
         self.tilt_zero = tilt0
         self.pan_id = pan_id
         self.tilt_id = tilt_id
+        self.extended_position = extended_position
         self.start()
         atexit.register(self.stop)
 
@@ -54,7 +62,7 @@ class Gimbal(hal.AbstractGimbal):
         self.tilt = xl430.Actuator(self.port, self.tilt_id)
         self.pan.set_torque_enable(False)
         self.tilt.set_torque_enable(False)
-        self.pan.set_operating_mode(3)
+        self.pan.set_operating_mode(4 if self.extended_position else 3)
         self.tilt.set_operating_mode(3)
         self.pan.set_torque_enable(True)
         self.tilt.set_torque_enable(True)
@@ -72,11 +80,16 @@ class Gimbal(hal.AbstractGimbal):
 
     def async_enabled(self) -> bool:
         return True
+
+    def multi_turn(self) -> bool:
+        return self.extended_position
     
     def moveto_async(self, pan: Deg, tilt: Deg) -> None:
         """
         Move to given angles (in degrees)
         """
+        if not self.extended_position:
+            pan = pan % 360
         pan = self.__pan_angle2steps(pan)
         tilt = self.__tilt_angle2steps(tilt)
         self.pan.set_goal_position(pan)
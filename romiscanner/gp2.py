@@ -23,21 +23,37 @@
 
 """
 import gphoto2 as gp
-import os
-import imageio
-import tempfile
 import atexit
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from romiscanner import hal, error
 from .hal import DataItem
 
+def file_format(file_path) -> str:
+    """Image format of a file on the camera, from its extension"""
+    return os.path.splitext(file_path.name)[1].lstrip(".").lower()
+
 class Camera(hal.AbstractCamera):
     """
     Gphoto2 Camera object.
+
+    Captures are triggered and their completion is awaited with gphoto2
+    events, images are read from the camera into memory and kept encoded. With
+    deferred_download, images are left on the card and downloaded in a
+    background thread while the scanner moves to the next pose; grab then
+    returns empty data items, filled by retrieve at the end of the scan.
     """
 
-    def __init__(self):
+    def __init__(self, deferred_download: bool=False, timeout: float=10.):
         self.camera = None
+        self.deferred_download = deferred_download
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = []
+        self.downloader = ThreadPoolExecutor(max_workers=1)
         self.start()
         atexit.register(self.stop)
 
@@ -50,24 +66,64 @@ class Camera(hal.AbstractCamera):
         self.is_started = True
 
     def stop(self):
+        self.downloader.shutdown()
         self.camera.exit()
         self.camera = None
 
     def channels(self):
         return ['rgb']
 
+    def capture(self):
+        """
+        Triggers a capture and waits for the file added event. Returns the
+        path of the new file on the camera.
+        """
+        with self.lock:
+            self.camera.trigger_capture()
+            t0 = time.time()
+            while True:
+                remaining = self.timeout - (time.time() - t0)
+                if remaining <= 0:
+                    raise error.Error("Capture timeout")
+                event_type, event_data = self.camera.wait_for_event(int(1000 * remaining))
+                if event_type == gp.GP_EVENT_FILE_ADDED:
+                    return event_data
+
+    def download(self, file_path) -> bytes:
+        """Reads a file from the camera into memory"""
+        with self.lock:
+            camera_file = self.camera.file_get(file_path.folder, file_path.name,
+                                               gp.GP_FILE_TYPE_NORMAL)
+            return bytes(memoryview(camera_file.get_data_and_size()))
+
+    def capture_bytes(self) -> bytes:
+        """Captures an image and returns the encoded file"""
+        return self.download(self.capture())
+
     def grab(self, idx: int, metadata: dict=None):
-        with tempfile.TemporaryDirectory as tmp:
-            fname = os.path.join(tmp, "frame.jpg")
-            self.grab_write(fname)
-            data_item = DataItem(idx, metadata)
-            data = imageio.imread(fname)
-            data_item.add_channel("rgb", data)
-            return data_item
+        return self.fetch(self.trigger(idx, metadata))
+
+    def trigger(self, idx: int, metadata: dict=None):
+        data_item = DataItem(idx, metadata)
+        file_path = self.capture()
+        if self.deferred_download:
+            self.pending.append((data_item, file_path, self.downloader.submit(self.download, file_path)))
+            return data_item, None
+        return data_item, file_path
+
+    def fetch(self, handle):
+        data_item, file_path = handle
+        if file_path is not None:
+            data_item.add_channel("rgb", encoded=self.download(file_path), fmt=file_format(file_path))
+        return data_item
+
+    def retrieve(self):
+        pending, self.pending = self.pending, []
+        for data_item, file_path, download in pending:
+            data_item.add_channel("rgb", encoded=download.result(), fmt=file_format(file_path))
+        return [data_item for data_item, _, _ in pending]
 
     def grab_write(self, target: str):
-        file_path = self.camera.capture(0)
-        camera_file = self.camera.file_get(file_path.folder, file_path.name,
-                                           gp.GP_FILE_TYPE_NORMAL)
-        gp.check_result(gp.gp_file_save(camera_file, target))
+        with open(target, "wb") as f:
+            f.write(self.capture_bytes())
         return target
@@ -45,6 +45,9 @@ class CNC(hal.AbstractCNC):
         self.x = 0
         self.y = 0
         self.z = 0
+        self.wco = [0, 0, 0] # work coordinate offset
+        self.state = None # state of the last status report
+        self.homed = False
         self.start(homing)
         atexit.register(self.stop)
 
@@ -74,21 +77,59 @@ class CNC(hal.AbstractCNC):
         self.send_cmd("$H")
         #self.send_cmd("g28") #reaching workspace origin
         self.send_cmd("g92 x0 y0 z0")
+        self.x = 0
+        self.y = 0
+        self.z = 0
+        self.homed = True
+
+    def is_homed(self):
+        return self.homed
 
     def moveto(self, x, y, z):
         self.moveto_async(x, y, z)
         self.wait()
 
     def moveto_async(self, x, y, z):
-        self.send_cmd("g0 x%s y%s z%s" % (int(x), int(y), int(z)))
-        self.x = int(x)
-        self.y = int(y)
-        self.z = int(z)
+        self.send_cmd("g0 x%.3f y%.3f z%.3f" % (x, y, z))
+        self.x = x
+        self.y = y
+        self.z = z
         time.sleep(0.1) # Add a little sleep between calls
 
+    def arc_enabled(self):
+        return True
+
+    def arcto_async(self, x, y, z, arc, feed):
+        # Center given relative to the start of the arc
+        self.send_cmd("%s x%.3f y%.3f z%.3f i%.3f j%.3f f%.1f" % (
+            "g2" if arc.clockwise else "g3", x, y, z,
+            arc.center_x - self.x, arc.center_y - self.y, feed))
+        self.x = x
+        self.y = y
+        self.z = z
+
     def wait(self):
         self.send_cmd("g4 p1")
 
+    def continuous_enabled(self):
+        return True
+
+    def moveto_continuous(self, x, y, z, feed):
+        self.send_cmd("g1 x%.3f y%.3f z%.3f f%.1f" % (x, y, z, feed))
+        self.x = x
+        self.y = y
+        self.z = z
+
+    def poll_position(self):
+        status = self.get_status()
+        if status is None or 'position' not in status:
+            raise hal.ScannerError("No position in the CNC status report")
+        self.state = status['status']
+        return status['time'], status['position']
+
+    def reported_state(self):
+        return self.state
+
 
     def send_cmd(self, cmd):
         self.serial_port.reset_input_buffer()
@@ -100,18 +141,30 @@ class CNC(hal.AbstractCNC):
         return grbl_out
 
     def get_status(self):
+        """
+        Queries a status report. Returns the state of the machine, the time
+        of the query and the position in work coordinates (WPos, or MPos
+        minus the last reported work coordinate offset).
+        """
         self.serial_port.write("?".encode("utf-8"))
+        t = time.time()
         try:
-            res = self.serial_port.readline()
-            res = res.decode("utf-8")
-            res = res[1:-1]
-            res = res.split('|')
-            print(res)
-            res_fmt = {}
-            res_fmt['status'] = res[0]
-            pos = res[1].split(':')[-1].split(',')
-            pos = [-float(p) for p in pos] # why - ?
-            res_fmt['position'] = pos
-        except:
+            while True: # Skip the responses to previous commands
+                res = self.serial_port.readline().decode("utf-8").strip()
+                if res == "":
+                    return None
+                if res.startswith("<"):
+                    break
+            res = res[1:-1].split('|')
+            res_fmt = {'status': res[0], 'time': t}
+            fields = dict(x.split(':', 1) for x in res[1:])
+            if 'WCO' in fields:
+                self.wco = [float(p) for p in fields['WCO'].split(',')]
+            if 'WPos' in fields:
+                res_fmt['position'] = [float(p) for p in fields['WPos'].split(',')]
+            elif 'MPos' in fields:
+                pos = [float(p) for p in fields['MPos'].split(',')]
+                res_fmt['position'] = [p - o for p, o in zip(pos, self.wco)]
+        except (UnicodeDecodeError, ValueError):
             return None
         return res_fmt
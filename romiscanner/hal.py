@@ -23,12 +23,18 @@
 
 """    
 import os
+import queue
+import tempfile
+import threading
+import time
 from abc import ABC, ABCMeta, abstractmethod
+from io import BytesIO
+import imageio
 import numpy as np
 
 from .units import *
 from . import path
-from typing import Tuple, List
+from typing import Tuple, List, Set
 from romidata.db import Fileset
 from romidata import io
 import logging
@@ -41,27 +47,175 @@ class ScannerError(Exception):
 class PathError(ScannerError):
     pass
 
+# Equivalent image file extensions
+_FORMATS = {"jpeg": "jpg", "tif": "tiff"}
+
+def same_format(fmt: str, ext: str) -> bool:
+    """Whether two image formats or file extensions are the same"""
+    fmt, ext = fmt.lower().lstrip("."), ext.lower().lstrip(".")
+    return _FORMATS.get(fmt, fmt) == _FORMATS.get(ext, ext)
+
 class ChannelData():
-    def __init__(self, name: str, data: np.array, idx: int):
-        self.data = data
+    """
+    Image of a channel. The image is either given as an array, or as the
+    encoded file (e.g. the JPEG from the camera) and its format, in which
+    case it is only decoded when data is accessed.
+    """
+    def __init__(self, name: str, data: np.array, idx: int, encoded: bytes=None, fmt: str=None):
+        if data is None and encoded is None:
+            raise ValueError("Channel %s has no data"%name)
+        if encoded is not None and fmt is None:
+            raise ValueError("Format of the encoded channel %s is missing"%name)
+        self._data = data
+        self.encoded = encoded
+        self.fmt = fmt
         self.idx = idx
         self.name = name
 
+    @property
+    def data(self) -> np.array:
+        if self._data is None:
+            self._data = imageio.imread(BytesIO(self.encoded), format=self.fmt)
+        return self._data
+
+    @data.setter
+    def data(self, data: np.array):
+        self._data = data
+        self.encoded = None
+        self.fmt = None
+
     def format_id(self):
         return "%05d_%s"%(self.idx, self.name)
 
 class DataItem():
-    def __init__(self, idx: int, metadata=None):
+    """
+    Channels of a shot. If spill_dir is set, the arrays of the channels are
+    memory mapped to files of this directory, so that the pages of the
+    channels waiting to be written can be evicted from memory. The files are
+    unlinked as soon as they are mapped, they are removed with the arrays.
+    """
+    def __init__(self, idx: int, metadata=None, spill_dir: str=None):
         self.channels = {}
         self.metadata = metadata
         self.idx = idx
+        self.spill_dir = spill_dir
 
-    def add_channel(self, channel_name: str, data: np.array) -> None:
-        self.channels[channel_name] = ChannelData(channel_name, data, self.idx)
+    def allocate_channel(self, channel_name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.array:
+        """Adds a channel filled with zeros, returns its array to be filled in place"""
+        if self.spill_dir is None:
+            data = np.zeros(shape, dtype=dtype)
+        else:
+            fd, fname = tempfile.mkstemp(prefix="%05d_%s-"%(self.idx, channel_name),
+                                         dir=self.spill_dir)
+            os.close(fd)
+            data = np.memmap(fname, dtype=dtype, mode="w+", shape=shape)
+            os.remove(fname)
+        self.add_channel(channel_name, data)
+        return data
+
+    def add_channel(self, channel_name: str, data: np.array=None,
+                    encoded: bytes=None, fmt: str=None) -> None:
+        if (data is not None and self.spill_dir is not None
+                and not isinstance(data, np.memmap)):
+            spilled = self.allocate_channel(channel_name, data.shape, data.dtype)
+            spilled[:] = data
+            return
+        self.channels[channel_name] = ChannelData(channel_name, data, self.idx,
+                                                  encoded=encoded, fmt=fmt)
 
     def channel(self, channel_name: str) -> ChannelData:
         return self.channels[channel_name]
 
+def write_data_item(data_item: DataItem, channels: List[str], ext: str, fileset: Fileset) -> None:
+    """Writes the given channels of a data item as files of the fileset"""
+    for c in channels:
+        channel = data_item.channels[c]
+        f = fileset.create_file(channel.format_id())
+        if channel.encoded is not None and same_format(channel.fmt, ext):
+            f.write_raw(channel.encoded, ext=ext) # no re-encoding
+        else:
+            io.write_image(f, channel.data, ext=ext)
+        # Single metadata write per file
+        metadata = {} if data_item.metadata is None else dict(data_item.metadata)
+        metadata["shot_id"] = "%06i"%data_item.idx
+        metadata["channel"] = c
+        f.set_metadata(metadata)
+
+def file_complete(f) -> bool:
+    """
+    Whether a file written by write_data_item is complete: its metadata,
+    written last, is present and the image is not truncated.
+    """
+    if f.filename is None or f.get_metadata("shot_id") is None:
+        return False
+    try:
+        data = f.read_raw()
+    except OSError:
+        return False
+    if len(data) == 0:
+        return False
+    ext = os.path.splitext(f.filename)[1]
+    if same_format(ext, "jpg"):
+        return data.rstrip(b"\0").endswith(b"\xff\xd9")
+    if same_format(ext, "png"):
+        return data.endswith(b"IEND\xaeB`\x82")
+    return True
+
+class ScanCheckpoint():
+    """
+    Progress of a scan, in the "checkpoint" metadata of its fileset: the
+    number of written shots and the index in the path of the last one. It
+    is updated after each written shot.
+    """
+    def __init__(self, fileset: Fileset, n_poses: int, start_count: int, n_written: int=0):
+        self.fileset = fileset
+        self.start_count = start_count
+        self.checkpoint = {"start_count": start_count, "n_poses": n_poses,
+                           "scan_count": start_count, "n_written": n_written,
+                           "last_index": None, "finished": False}
+        self.fileset.set_metadata("checkpoint", self.checkpoint)
+
+    def written(self, idx: int, scan_count: int) -> None:
+        self.checkpoint["n_written"] += 1
+        self.checkpoint["last_index"] = idx - self.start_count
+        self.checkpoint["scan_count"] = scan_count
+        self.fileset.set_metadata("checkpoint", self.checkpoint)
+
+    def finish(self) -> None:
+        self.checkpoint["finished"] = True
+        self.fileset.set_metadata("checkpoint", self.checkpoint)
+
+def completed_shots(path: path.Path, fileset: Fileset, channels: List[str]) -> Tuple[Set[int], int]:
+    """
+    Reads the checkpoint of an interrupted scan of the path in the fileset.
+    Returns the indices in the path of the shots whose files are all
+    complete, and the shot count the interrupted scan started from. Deletes
+    the files of the other shots.
+    """
+    checkpoint = fileset.get_metadata("checkpoint")
+    if checkpoint is None:
+        if len(fileset.get_files()) > 0:
+            raise ScannerError("Cannot resume a scan without checkpoint")
+        return set(), None
+    if checkpoint["n_poses"] != len(path):
+        raise ScannerError("The checkpoint does not match the scan path")
+    start_count = checkpoint["start_count"]
+
+    completed = set()
+    for i in range(len(path)):
+        files = [fileset.get_file("%05d_%s"%(start_count + i, c)) for c in channels]
+        if all(f is not None and file_complete(f) for f in files):
+            completed.add(i)
+    for f in fileset.get_files():
+        try:
+            i = int(f.id.split("_")[0]) - start_count
+        except ValueError:
+            continue
+        if i not in completed:
+            fileset.delete_file(f.id)
+    logger.info("resuming scan, %i/%i shots complete"%(len(completed), len(path)))
+    return completed, start_count
+
 class AbstractCNC(metaclass=ABCMeta):
     def __init__(self):
         pass
@@ -70,6 +224,10 @@ class AbstractCNC(metaclass=ABCMeta):
     def home(self) -> None:
         pass
 
+    def is_homed(self) -> bool:
+        """Whether the CNC was homed since it was started"""
+        return False
+
     @abstractmethod    
     def get_position(self) -> Tuple[Length_mm, Length_mm, Length_mm]:
         pass
@@ -90,6 +248,32 @@ class AbstractCNC(metaclass=ABCMeta):
     def wait(self) -> None:
         pass
 
+    def arc_enabled(self) -> bool:
+        """Whether the CNC can follow circular arcs"""
+        return False
+
+    def arcto_async(self, x: Length_mm, y: Length_mm, z: Length_mm, arc: path.Arc, feed: float) -> None:
+        """Moves to (x, y, z) along an arc at the given feed rate (mm/min)"""
+        raise NotImplementedError
+
+    def continuous_enabled(self) -> bool:
+        """Whether moves can be queued and the position polled while moving"""
+        return False
+
+    def moveto_continuous(self, x: Length_mm, y: Length_mm, z: Length_mm, feed: float) -> None:
+        """Queues a linear move at the given feed rate (mm/min), without
+        stopping at the end of the previous move"""
+        raise NotImplementedError
+
+    def poll_position(self) -> Tuple[float, Tuple[Length_mm, Length_mm, Length_mm]]:
+        """Returns the time and the position reported by the controller"""
+        raise NotImplementedError
+
+    def reported_state(self) -> str:
+        """State of the machine reported with the last polled position
+        (e.g. "Idle", "Run" or "Alarm"), None if unknown"""
+        return None
+
 class AbstractGimbal(ABC):
     @abstractmethod
     def has_position_control(self) -> bool:
@@ -115,6 +299,11 @@ class AbstractGimbal(ABC):
     def wait(self) -> None:
         pass
 
+    def multi_turn(self) -> bool:
+        """Whether the pan axis can turn beyond a single turn, so that
+        unwrapped pan angles are followed as given"""
+        return True
+
     
 class AbstractCamera():
     @abstractmethod
@@ -125,6 +314,25 @@ class AbstractCamera():
     def channels(self):
         pass
 
+    def trigger(self, idx: int, metadata: dict=None):
+        """
+        Captures a shot and returns a handle from which fetch transfers its
+        data item, so that the transfer can overlap with the next move. By
+        default, the shot is grabbed at once.
+        """
+        return self.grab(idx, metadata)
+
+    def fetch(self, handle) -> DataItem:
+        """Data item of a shot captured by trigger"""
+        return handle
+
+    def retrieve(self) -> List[DataItem]:
+        """
+        Returns the data items whose transfer was deferred to the end of the
+        scan, grab then returns data items without channels.
+        """
+        return []
+
 
 class AbstractScanner(metaclass=ABCMeta):
     def __init__(self):
@@ -148,6 +356,22 @@ class AbstractScanner(metaclass=ABCMeta):
     def channels(self) -> List[str]:
         pass
 
+    def trigger(self, idx: int, metadata: dict=None):
+        """Captures a shot, see ``AbstractCamera.trigger``"""
+        return self.grab(idx, metadata)
+
+    def fetch(self, handle) -> DataItem:
+        """Data item of a shot captured by trigger"""
+        return handle
+
+    def retrieve(self) -> List[DataItem]:
+        """Data items whose transfer was deferred to the end of the scan"""
+        return []
+
+    def home(self) -> None:
+        """Brings the scanner to a known state before resuming a scan"""
+        pass
+
     def inc_count(self) -> int:
         x = self.scan_count
         self.scan_count += 1
@@ -163,26 +387,131 @@ class AbstractScanner(metaclass=ABCMeta):
                 setattr(target_pose, attr, getattr(x, attr))
         return target_pose 
 
-    def scan(self, path: path.Path, fileset: Fileset) -> None:
-        for x in path:
+    def set_position_arc(self, pose: path.Pose, arc: path.Arc) -> None:
+        """Moves to the pose along an arc, by default in a straight line"""
+        self.set_position(pose)
+
+    def scan(self, path: path.Path, fileset: Fileset, prefetch: int=0, resume: bool=False) -> None:
+        """
+        Scans along the path and writes the shots in the fileset. The
+        progress is checkpointed in the "checkpoint" metadata of the fileset
+        after each written shot (the number of written shots and the index in
+        the path of the last one). With resume, the complete shots of an
+        interrupted scan are kept and only the missing poses are scanned.
+        """
+        completed = set()
+        if resume:
+            completed = self.completed_shots(path, fileset)
+            self.home()
+        checkpoint = ScanCheckpoint(fileset, len(path), self.scan_count, len(completed))
+        for data_item, _, _ in self.scan_iter(path, prefetch=prefetch, skip=completed):
+            self.write_data_item(data_item, fileset)
+            checkpoint.written(data_item.idx, self.scan_count)
+        checkpoint.finish()
+
+    def completed_shots(self, path: path.Path, fileset: Fileset) -> Set[int]:
+        """
+        Reads the checkpoint of an interrupted scan of the path in the
+        fileset, see ``completed_shots``. The shot count restarts from the
+        one of the interrupted scan.
+        """
+        completed, start_count = completed_shots(path, fileset, self.channels())
+        if start_count is not None:
+            self.scan_count = start_count
+        return completed
+
+    def scan_iter(self, path: path.Path, prefetch: int=0, skip: Set[int]=None):
+        """
+        Scans along the path, yielding (data_item, pose, timings) for each
+        shot as soon as it is available. timings gives the durations of the
+        steps of the shot, in seconds. Shots whose transfer is deferred are
+        yielded at the end of the scan, with a None pose.
+
+        With prefetch=0, the next shot is only taken when the consumer asks
+        for it. Otherwise, shots are taken in a background thread, at most
+        prefetch shots ahead of the consumer, or without limit if prefetch is
+        None. The poses whose index in the path is in skip are not scanned.
+        """
+        skip = set() if skip is None else skip
+        shots = (shot for shot in self._iter_shots(path, skip) if len(shot[0].channels) > 0)
+        if prefetch is not None and prefetch <= 0:
+            yield from shots
+            return
+
+        shot_queue = queue.Queue(maxsize=0 if prefetch is None else prefetch)
+        stop = threading.Event()
+        def put(x):
+            while not stop.is_set():
+                try:
+                    shot_queue.put(x, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+        def produce():
+            try:
+                for shot in shots:
+                    put(shot)
+                    if stop.is_set():
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                x = shot_queue.get()
+                if x is None:
+                    return
+                if isinstance(x, Exception):
+                    raise x
+                yield x
+        finally:
+            stop.set()
+            producer.join()
+
+    def _iter_shots(self, path: path.Path, skip: Set[int]):
+        """Moves and grabs at each pose of the path, then retrieves the
+        deferred shots. Yields all data items, including empty ones. Arcs
+        start from the previous pose of the path: after skipped poses, the
+        scanner moves in a straight line."""
+        last = -1 if len(skip) == 0 else None
+        for i, x in enumerate(path):
+            if i in skip:
+                self.inc_count() # shot ids stay the indices in the path
+                continue
             pose = self.get_target_pose(x)
-            print(pose)
-            data_item = self.scan_at(pose, x.exact_pose)
-            for c in self.channels():
-                f = fileset.create_file(data_item.channels[c].format_id())
-                io.write_image(f, data_item.channels[c].data, ext=self.ext)
-                if data_item.metadata is not None:
-                    f.set_metadata(data_item.metadata)
-                f.set_metadata("shot_id", "%06i"%data_item.idx) 
-                f.set_metadata("channel", c) 
-    
-    def scan_at(self, pose: path.Pose, exact_pose: bool=True, metadata: dict={}) -> DataItem:
-        logger.debug("scanning at")
-        logger.debug(pose)
+            logger.debug(pose)
+            t0 = time.time()
+            self.move_to(pose, x.arc if last == i - 1 else None)
+            last = i
+            t1 = time.time()
+            data_item = self.grab(self.inc_count(), metadata=self.pose_metadata(pose, x.exact_pose))
+            yield data_item, pose, {"move": t1 - t0, "grab": time.time() - t1}
+        t0 = time.time()
+        data_items = self.retrieve()
+        for data_item in data_items:
+            yield data_item, None, {"retrieve": time.time() - t0}
+
+    def write_data_item(self, data_item: DataItem, fileset: Fileset) -> None:
+        write_data_item(data_item, self.channels(), self.ext, fileset)
+
+    def pose_metadata(self, pose: path.Pose, exact_pose: bool=True, metadata: dict={}) -> dict:
         if exact_pose:
-            metadata = {**metadata, "pose": [pose.x,pose.y,pose.z,pose.pan,pose.tilt]}
+            return {**metadata, "pose": [pose.x,pose.y,pose.z,pose.pan,pose.tilt]}
+        return {**metadata, "approximate_pose": [pose.x,pose.y,pose.z,pose.pan,pose.tilt]}
+
+    def move_to(self, pose: path.Pose, arc: path.Arc=None) -> None:
+        if arc is not None:
+            self.set_position_arc(pose, arc)
         else:
-            metadata = {**metadata, "approximate_pose": [pose.x,pose.y,pose.z,pose.pan,pose.tilt]}
+            self.set_position(pose)
+
+    def scan_at(self, pose: path.Pose, exact_pose: bool=True, metadata: dict={},
+                arc: path.Arc=None) -> DataItem:
+        logger.debug("scanning at")
+        logger.debug(pose)
+        metadata = self.pose_metadata(pose, exact_pose, metadata)
         logger.debug(metadata)
-        self.set_position(pose)
+        self.move_to(pose, arc)
         return self.grab(self.inc_count(), metadata=metadata)
@@ -43,15 +43,27 @@ class Pose():
     def attributes(self):
         return ["x", "y", "z", "pan", "tilt"]
 
+class Arc():
+    """
+    Circular arc in the xy plane around (center_x, center_y), followed to
+    reach a path element from the previous one.
+    """
+    def __init__(self, center_x: Length_mm, center_y: Length_mm, clockwise: bool=False):
+        self.center_x = center_x
+        self.center_y = center_y
+        self.clockwise = clockwise
+
 class PathElement(Pose):
     def __init__(self, x: Length_mm=None,
                      y: Length_mm=None,
                      z: Length_mm=None,
                      pan: Deg=None,
                      tilt: Deg=None,
-                     exact_pose: bool=True):
+                     exact_pose: bool=True,
+                     arc: Arc=None):
         super().__init__(x, y, z, pan, tilt)
         self.exact_pose = exact_pose
+        self.arc = arc
 
     def __repr__(self):
         res = []
@@ -60,6 +72,30 @@ class PathElement(Pose):
                 res.append("%s = %.2f"%(attr, getattr(self, attr)))
         return ", ".join(res)
 
+def nearest_pan(current: Deg, target: Deg, pan_limits: Optional[List[Deg]]=None) -> Deg:
+    """
+    Angle equivalent to target (modulo 360) reached from current with the
+    shortest rotation, within the [min, max] pan_limits if given.
+    """
+    pan = current + (target - current + 180) % 360 - 180
+    if pan_limits is None:
+        return pan
+    lo, hi = pan_limits
+    candidates = [pan + 360 * k for k in range(math.ceil((lo - pan) / 360),
+                                               math.floor((hi - pan) / 360) + 1)]
+    if len(candidates) == 0:
+        raise ValueError("No pan angle equivalent to %.2f in [%.2f, %.2f]"%(target, lo, hi))
+    return min(candidates, key=lambda p: abs(p - current))
+
+def unwrap_pan(pans: List[Deg], start: Deg=0, pan_limits: Optional[List[Deg]]=None) -> List[Deg]:
+    """Unwraps a sequence of pan angles so that each move, starting from
+    start, takes the shortest rotation allowed by the limits"""
+    res = []
+    for pan in pans:
+        start = nearest_pan(start, pan, pan_limits)
+        res.append(start)
+    return res
+
 class Path(List[PathElement]):
     def __init__(self):
         self = list()
@@ -73,7 +109,8 @@ class Circle(Path):
             y = center_y - radius * math.sin(pan)
             pan = pan * 180 / math.pi
             pan = (pan - 90) % 360
-            self.append(PathElement(x, y, z, pan, tilt, exact_pose=False))
+            arc = Arc(center_x, center_y) if i > 0 else None
+            self.append(PathElement(x, y, z, pan, tilt, exact_pose=False, arc=arc))
 
 class Line(Path):
     def __init__(self, x_0: Length_mm, y_0: Length_mm, z_0: Length_mm,
@@ -0,0 +1,463 @@
+"""
+
+    romiscanner - Python tools for the ROMI 3D Scanner
+
+    Copyright (C) 2018 Sony Computer Science Laboratories
+    Authors: D. Colliaux, T. Wintz, P. Hanappe
+
+    This file is part of romiscanner.
+
+    romiscanner is free software: you can redistribute it
+    and/or modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    romiscanner is distributed in the hope that it will be
+    useful, but WITHOUT ANY WARRANTY; without even the implied
+    warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+    See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with romiscanner.  If not, see
+    <https://www.gnu.org/licenses/>.
+
+"""
+# Software rasterizer for the ground truth of virtual scans.
+#
+# Renders class masks, a label image and a depth map of a plant mesh split
+# by material (the output of ``romi_split_by_material``) with NumPy only, so
+# that ground truth can be generated without Blender. The camera follows the
+# conventions of ``romi_virtualscanner``: ``intrinsics`` and ``extrinsics``
+# give the same K and RT as ``Camera.get_K`` and ``Camera.get_RT`` for the
+# intrinsics and poses set by ``VirtualScanner``.
+#
+# As with the ``render_class`` endpoint of the virtual scanner, the mask of a
+# class is the coverage of that class alone (other classes do not occlude
+# it), whereas the label image and the depth map are z-buffered over all
+# classes. Masks are binary, whereas Blender anti-aliases the edges: compare
+# them with ``mask_iou`` after thresholding the Blender masks (see
+# ``romi_raster_validate``).
+import math
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from romiscanner import path
+from romiscanner.hal import AbstractScanner, DataItem
+from .log import logger
+
+NEAR_CLIP = 1e-3
+
+
+class Mesh():
+    """
+    Triangle mesh with one material per face.
+    """
+    def __init__(self, vertices: np.array, faces: np.array,
+                 face_materials: np.array, materials: List[str]):
+        self.vertices = vertices
+        self.faces = faces
+        self.face_materials = face_materials
+        self.materials = materials
+
+    def face_classes(self, classes: List[str]) -> np.array:
+        """
+        Index of the class of each face (-1 if none), a face belongs to a
+        class if the class name is contained in its material name.
+        """
+        material_class = np.full(len(self.materials) + 1, -1)
+        for i, m in enumerate(self.materials):
+            for j, c in enumerate(classes):
+                if c in m:
+                    material_class[i] = j
+                    break
+        return material_class[self.face_materials]
+
+
+def load_obj(fname: str, y_up: bool=True) -> Mesh:
+    """
+    Loads an OBJ file. Polygons are triangulated as fans.
+
+    Parameters
+    ----------
+    fname : str
+        OBJ file
+    y_up : bool
+        the file uses the Y up convention of the Blender OBJ exporter, the
+        mesh is converted back to the Blender Z up frame
+    """
+    vertices = []
+    faces = []
+    face_materials = []
+    materials = []
+    current = -1
+    with open(fname) as f:
+        for line in f:
+            items = line.split()
+            if len(items) == 0:
+                continue
+            if items[0] == "v":
+                vertices.append([float(x) for x in items[1:4]])
+            elif items[0] == "usemtl":
+                name = " ".join(items[1:])
+                if name not in materials:
+                    materials.append(name)
+                current = materials.index(name)
+            elif items[0] == "f":
+                idx = [int(x.split("/")[0]) for x in items[1:]]
+                idx = [i - 1 if i > 0 else len(vertices) + i for i in idx]
+                for k in range(1, len(idx) - 1):
+                    faces.append([idx[0], idx[k], idx[k+1]])
+                    face_materials.append(current)
+
+    vertices = np.array(vertices, dtype=np.float64).reshape(-1, 3)
+    if y_up:
+        vertices = np.stack([vertices[:, 0], -vertices[:, 2], vertices[:, 1]], axis=1)
+    return Mesh(vertices, np.array(faces, dtype=np.int64).reshape(-1, 3),
+                np.array(face_materials, dtype=np.int64), materials)
+
+
+def intrinsics(width: int, height: int, focal: float) -> np.array:
+    """
+    K matrix of the virtual scanner camera for the given intrinsics
+    (focal length in 35mm equivalent, see ``Camera.set_intrinsics``).
+    """
+    f = max(width, height) * focal / 70
+    return np.array([[f, 0, width / 2],
+                     [0, f, height / 2],
+                     [0, 0, 1]])
+
+
+def extrinsics(pose: path.Pose) -> Tuple[np.array, np.array]:
+    """
+    World to camera (computer vision convention) rotation and translation
+    of the virtual scanner camera at the given pose.
+    """
+    rx = math.radians(90 - pose.tilt)
+    rz = math.radians(pose.pan)
+    Rx = np.array([[1, 0, 0],
+                   [0, math.cos(rx), -math.sin(rx)],
+                   [0, math.sin(rx), math.cos(rx)]])
+    Rz = np.array([[math.cos(rz), -math.sin(rz), 0],
+                   [math.sin(rz), math.cos(rz), 0],
+                   [0, 0, 1]])
+    R_bcam2cv = np.diag([1., -1., -1.])
+    R_world2bcam = (Rz @ Rx).T
+    location = np.array([pose.x, pose.y, pose.z], dtype=np.float64)
+    R = R_bcam2cv @ R_world2bcam
+    T = -R @ location
+    return R, T
+
+
+def camera_from_metadata(camera: dict) -> Tuple[np.array, np.array, np.array, int, int]:
+    """
+    K, R, T, width and height from the "camera" metadata of a virtual scan.
+    """
+    model = camera["camera_model"]
+    fx, fy, cx, cy = model["params"][:4]
+    K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
+    return K, np.array(camera["rotmat"]), np.array(camera["tvec"]), model["width"], model["height"]
+
+
+def _rasterize_tile(tri, inv_z, tri_class, n_classes, x0, y0, w, h, chunk_size):
+    """
+    Z-buffer of a tile. Returns the 1/z buffer, the index of the visible
+    triangle (-1 if none) and the coverage of each class.
+    """
+    xs, ys = np.meshgrid(np.arange(x0, x0 + w) + 0.5, np.arange(y0, y0 + h) + 0.5)
+    px = xs.ravel()
+    py = ys.ravel()
+    best = np.zeros(w*h)
+    best_tri = np.full(w*h, -1)
+    coverage = np.zeros((n_classes, w*h), dtype=bool)
+
+    for start in range(0, len(tri), chunk_size):
+        t = tri[start:start + chunk_size]
+        ax, ay = t[:, 0, 0, None], t[:, 0, 1, None]
+        bx, by = t[:, 1, 0, None], t[:, 1, 1, None]
+        cx, cy = t[:, 2, 0, None], t[:, 2, 1, None]
+        area = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+        w0 = ((cx - bx) * (py - by) - (cy - by) * (px - bx)) / area
+        w1 = ((ax - cx) * (py - cy) - (ay - cy) * (px - cx)) / area
+        w2 = 1 - w0 - w1
+        inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+
+        iz = inv_z[start:start + chunk_size]
+        z = w0 * iz[:, 0, None] + w1 * iz[:, 1, None] + w2 * iz[:, 2, None]
+        z = np.where(inside, z, 0)
+        k = np.argmax(z, axis=0)
+        zk = z[k, np.arange(w*h)]
+        closer = zk > best
+        best[closer] = zk[closer]
+        best_tri[closer] = start + k[closer]
+
+        cls = tri_class[start:start + chunk_size]
+        for c in np.unique(cls):
+            if c >= 0:
+                coverage[c] |= inside[cls == c].any(axis=0)
+
+    return best.reshape(h, w), best_tri.reshape(h, w), coverage.reshape(n_classes, h, w)
+
+
+def _render_band(args):
+    tri, inv_z, tri_class, bbox, n_classes, y0, y1, width, tile_size, chunk_size = args
+    h = y1 - y0
+    inv_depth = np.zeros((h, width))
+    labels = np.zeros((h, width), dtype=np.int64)
+    coverage = np.zeros((n_classes, h, width), dtype=bool)
+    for x0 in range(0, width, tile_size):
+        x1 = min(x0 + tile_size, width)
+        sel = ((bbox[:, 0] < x1) & (bbox[:, 2] > x0) &
+               (bbox[:, 1] < y1) & (bbox[:, 3] > y0))
+        if not sel.any():
+            continue
+        b, t, c = _rasterize_tile(tri[sel], inv_z[sel], tri_class[sel],
+                                  n_classes, x0, y0, x1 - x0, h, chunk_size)
+        inv_depth[:, x0:x1] = b
+        visible = t >= 0
+        labels[:, x0:x1][visible] = tri_class[sel][t[visible]] + 1
+        coverage[:, :, x0:x1] = c
+    return y0, inv_depth, labels, coverage
+
+
+def project(mesh: Mesh, classes: List[str], K: np.array, R: np.array, T: np.array,
+            width: int, height: int) -> Tuple[np.array, np.array, np.array, np.array]:
+    """
+    Projects the triangles of the classes in the image. Returns the image
+    coordinates of their vertices, the inverse of their depths, their class
+    and their bounding boxes, for the triangles in the image only.
+    """
+    face_class = mesh.face_classes(classes)
+    faces = mesh.faces[face_class >= 0]
+    face_class = face_class[face_class >= 0]
+
+    points = mesh.vertices @ np.asarray(R).T + np.asarray(T).reshape(1, 3)
+    z = points[:, 2]
+    uv = points[:, :2] / np.where(z > NEAR_CLIP, z, 1)[:, None]
+    uv = uv @ np.asarray(K)[:2, :2].T + np.asarray(K)[:2, 2]
+
+    # Triangles crossing the near plane are dropped rather than clipped
+    keep = (z[faces] > NEAR_CLIP).all(axis=1)
+    faces = faces[keep]
+    face_class = face_class[keep]
+    tri = uv[faces]
+    inv_z = 1 / z[faces]
+    bbox = np.concatenate([tri.min(axis=1), tri.max(axis=1)], axis=1)
+    area = ((tri[:, 1, 0] - tri[:, 0, 0]) * (tri[:, 2, 1] - tri[:, 0, 1]) -
+            (tri[:, 1, 1] - tri[:, 0, 1]) * (tri[:, 2, 0] - tri[:, 0, 0]))
+    keep = ((bbox[:, 2] > 0) & (bbox[:, 0] < width) &
+            (bbox[:, 3] > 0) & (bbox[:, 1] < height) &
+            (np.abs(area) > 1e-12))
+    return tri[keep], inv_z[keep], face_class[keep], bbox[keep]
+
+
+def _band_job(view, n_classes, y0, y1, width, tile_size, chunk_size):
+    tri, inv_z, face_class, bbox = view
+    sel = (bbox[:, 1] < y1) & (bbox[:, 3] > y0)
+    return (tri[sel], inv_z[sel], face_class[sel], bbox[sel],
+            n_classes, y0, y1, width, tile_size, chunk_size)
+
+
+# Mesh and last projected view of a RasterPool worker process
+_worker = {}
+
+
+def _init_worker(mesh, classes):
+    _worker["mesh"] = mesh
+    _worker["classes"] = classes
+    _worker["view_key"] = None
+
+
+def _render_worker_band(args):
+    """Renders a band of a view of the mesh of the worker, the view is
+    projected once by each worker"""
+    K, R, T, width, height, y0, y1, tile_size, chunk_size = args
+    key = (np.asarray(K).tobytes(), np.asarray(R).tobytes(), np.asarray(T).tobytes(), width, height)
+    if _worker["view_key"] != key:
+        _worker["view"] = project(_worker["mesh"], _worker["classes"], K, R, T, width, height)
+        _worker["view_key"] = key
+    return _render_band(_band_job(_worker["view"], len(_worker["classes"]),
+                                  y0, y1, width, tile_size, chunk_size))
+
+
+def _assemble(bands, classes, width, height):
+    inv_depth = np.zeros((height, width))
+    labels = np.zeros((height, width), dtype=np.int64)
+    coverage = np.zeros((len(classes), height, width), dtype=bool)
+    for y0, b, l, c in bands:
+        inv_depth[y0:y0 + b.shape[0]] = b
+        labels[y0:y0 + b.shape[0]] = l
+        coverage[:, y0:y0 + b.shape[0]] = c
+
+    depth = np.zeros((height, width))
+    depth[inv_depth > 0] = 1 / inv_depth[inv_depth > 0]
+    masks = {c: coverage[i].astype(np.uint8) * 255 for i, c in enumerate(classes)}
+    return masks, labels, depth
+
+
+class RasterPool():
+    """
+    Process pool rendering views of a mesh by bands of rows. The mesh is
+    sent once to each worker, which then only receives the camera of each
+    view and projects the mesh itself.
+    """
+    def __init__(self, mesh: Mesh, classes: List[str], n_workers: int):
+        self.classes = classes
+        self.executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                            initargs=(mesh, classes))
+
+    def render(self, K: np.array, R: np.array, T: np.array, width: int, height: int,
+               tile_size: int=64, chunk_size: int=256) -> Tuple[Dict[str, np.array], np.array, np.array]:
+        """See ``render``"""
+        K, R, T = np.asarray(K, dtype=np.float64), np.asarray(R, dtype=np.float64), np.asarray(T, dtype=np.float64)
+        jobs = [(K, R, T, width, height, y0, min(y0 + tile_size, height), tile_size, chunk_size)
+                for y0 in range(0, height, tile_size)]
+        bands = list(self.executor.map(_render_worker_band, jobs))
+        return _assemble(bands, self.classes, width, height)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+
+def render(mesh: Mesh, classes: List[str], K: np.array, R: np.array, T: np.array,
+           width: int, height: int, tile_size: int=64, chunk_size: int=256,
+           n_workers: int=1) -> Tuple[Dict[str, np.array], np.array, np.array]:
+    """
+    Renders the class masks, labels and depth of a mesh.
+
+    Parameters
+    ----------
+    mesh : Mesh
+        mesh to render
+    classes : list of str
+        classes to render, faces of other materials are ignored
+    K, R, T : np.array
+        intrinsics and world to camera transform (computer vision
+        convention, see ``intrinsics`` and ``extrinsics``)
+    width, height : int
+        image size
+    tile_size : int
+        size of the square tiles the image is rendered by
+    chunk_size : int
+        number of triangles rasterized at once in a tile
+    n_workers : int
+        number of processes, rows of tiles are distributed among them (use
+        a ``RasterPool`` to render several views with the same processes)
+
+    Returns
+    -------
+    masks : dict
+        uint8 mask (0 or 255) of each class
+    labels : np.array
+        index of the visible class plus one, 0 for the background
+    depth : np.array
+        depth along the optical axis of the visible surface, 0 for the
+        background
+    """
+    if n_workers > 1:
+        pool = RasterPool(mesh, classes, n_workers)
+        try:
+            return pool.render(K, R, T, width, height, tile_size, chunk_size)
+        finally:
+            pool.close()
+
+    view = project(mesh, classes, K, R, T, width, height)
+    logger.debug("rasterizing %i triangles"%len(view[0]))
+    bands = [_render_band(_band_job(view, len(classes), y0, min(y0 + tile_size, height),
+                                    width, tile_size, chunk_size))
+             for y0 in range(0, height, tile_size)]
+    return _assemble(bands, classes, width, height)
+
+
+def mask_iou(mask: np.array, reference: np.array, threshold: int=128) -> float:
+    """
+    Intersection over union of two masks, e.g. a rasterized mask and the
+    Blender mask of the same class and view.
+    """
+    a = mask >= threshold
+    b = reference >= threshold
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.0
+    return np.logical_and(a, b).sum() / union
+
+
+class RasterScanner(AbstractScanner):
+    """
+    Scanner rendering the ground truth channels of a virtual scan (class
+    masks and background) with the software rasterizer, with the same
+    camera conventions as the VirtualScanner. With several workers, the
+    processes are kept for all the shots of the loaded object, until close.
+    """
+    def __init__(self, width: int, # image width
+                       height: int, # image height
+                       focal: float, # camera focal
+                       classes: List[str], # list of classes to render
+                       tile_size: int=64,
+                       n_workers: int=1,
+                       spill_dir: str=None): # memory map the channels to this directory
+        super().__init__()
+        self.spill_dir = spill_dir
+        self.width = width
+        self.height = height
+        self.focal = focal
+        self.classes = classes
+        self.tile_size = tile_size
+        self.n_workers = n_workers
+        self.ext = "png"
+        self.mesh = None
+        self.pool = None
+        self.position = path.Pose()
+
+    def load_object(self, fname: str) -> None:
+        self.close()
+        self.mesh = load_obj(fname)
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def get_position(self) -> path.Pose:
+        return self.position
+
+    def set_position(self, pose: path.Pose) -> None:
+        self.position = pose
+
+    def channels(self) -> List[str]:
+        return self.classes + ['background']
+
+    def render(self):
+        K = intrinsics(self.width, self.height, self.focal)
+        R, T = extrinsics(self.position)
+        if self.n_workers > 1:
+            if self.pool is None:
+                self.pool = RasterPool(self.mesh, self.classes, self.n_workers)
+            return self.pool.render(K, R, T, self.width, self.height, tile_size=self.tile_size)
+        return render(self.mesh, self.classes, K, R, T, self.width, self.height,
+                      tile_size=self.tile_size)
+
+    def grab(self, idx: int, metadata: dict=None) -> DataItem:
+        if metadata is None:
+            metadata = {}
+        masks, labels, depth = self.render()
+
+        data_item = DataItem(idx, metadata, spill_dir=self.spill_dir)
+        for c in self.classes:
+            data_item.add_channel(c, masks[c])
+        data_item.add_channel("background", 255 * (labels == 0).astype(np.uint8))
+
+        K = intrinsics(self.width, self.height, self.focal)
+        R, T = extrinsics(self.position)
+        metadata["camera"] = {
+            "camera_model" : {
+                "width" : self.width,
+                "height" : self.height,
+                "model" : "OPENCV",
+                "params" : [ K[0][0], K[1][1], K[0][2], K[1][2], 0.0, 0.0, 0.0, 0.0 ]
+            },
+            "rotmat" : R.tolist(),
+            "tvec" : T.tolist()
+        }
+        return data_item
@@ -1,3 +1,4 @@
+import asyncio
 import importlib
 import json
 import os
@@ -7,10 +8,12 @@ import luigi
 from romidata import RomiTask, FilesetTarget, DatabaseConfig, io
 
 from romidata.task import FilesetExists
+from romiscanner import aio
+from romiscanner.cache import SceneCache
 from romiscanner.configs.lpy import VirtualPlantConfig
 from romiscanner.configs.scan import ScanPath
 from romiscanner.log import logger
-from romiscanner.scanner import Scanner
+from romiscanner.scanner import MultiCameraScanner, Scanner
 from romiscanner.tasks.lpy import VirtualPlant
 from romiscanner.vscan import VirtualScanner
 
@@ -35,6 +38,18 @@ class PaletteFileset(FilesetExists):
     fileset_id = "palette"
 
 
+def scan_finished(fileset):
+    """Whether the scan written in the fileset was not interrupted (scans
+    written before checkpoints were introduced have no checkpoint)"""
+    checkpoint = fileset.get_metadata("checkpoint")
+    return checkpoint is None or checkpoint.get("finished", False)
+
+
+def clear_fileset(fileset):
+    for f in fileset.get_files():
+        fileset.delete_file(f.id)
+
+
 class Scan(RomiTask):
     """ A task for running a scan, real or virtual.
 
@@ -46,7 +61,18 @@ class Scan(RomiTask):
     metadata : DictParameter
         metadata for the scan
     scanner : DictParameter
-        scanner hardware configuration (TODO: see hardware documentation)
+        scanner hardware configuration (TODO: see hardware documentation).
+        Instead of a single "camera", a list of "cameras" can be given, each
+        with a "name", a "module", "kwargs" and an optional "offset"
+        [dx, dy, dz, dpan, dtilt] (see ``MultiCameraScanner``).
+        Options of the scanner, e.g. the fly-by mode, are given in "kwargs".
+    asynchronous : BoolParameter
+        run the scan with the asyncio scan loop, moving the CNC and gimbal
+        concurrently and transferring and writing each shot during the next
+        move
+    resume : BoolParameter
+        resume an interrupted scan from its checkpoint, keeping its complete
+        shots, instead of starting over
     path : DictParameter
         scanner path configuration (TODO: see hardware documentation)
 
@@ -55,6 +81,8 @@ class Scan(RomiTask):
 
     metadata = luigi.DictParameter(default={})
     scanner = luigi.DictParameter(default={})
+    asynchronous = luigi.BoolParameter(default=False)
+    resume = luigi.BoolParameter(default=False)
 
     def requires(self):
         return []
@@ -65,9 +93,20 @@ class Scan(RomiTask):
         """
         return FilesetTarget(DatabaseConfig().scan, "images")
 
-    def get_path(self):
-        path_module = importlib.import_module(ScanPath().module)
-        path = getattr(path_module, ScanPath().class_name)(**ScanPath().kwargs)
+    def complete(self):
+        """An interrupted scan is not complete"""
+        return super().complete() and scan_finished(self.output().get())
+
+    def get_path(self, path_config=None):
+        """Builds the scan path from the ScanPath configuration, or from a
+        dictionary with the same "module", "class_name" and "kwargs" keys."""
+        if path_config is None:
+            path_config = {}
+        module = path_config.get("module", ScanPath().module)
+        class_name = path_config.get("class_name", ScanPath().class_name)
+        kwargs = path_config.get("kwargs", ScanPath().kwargs)
+        path_module = importlib.import_module(module)
+        path = getattr(path_module, class_name)(**kwargs)
         return path
 
     def load_scanner(self):
@@ -83,11 +122,23 @@ class Scan(RomiTask):
         gimbal_module = importlib.import_module(gimbal_module)
         gimbal = getattr(gimbal_module, "Gimbal")(**gimbal_kwargs)
 
-        camera_module = scanner_config["camera"]["module"]
-        camera_kwargs = scanner_config["camera"]["kwargs"]
-        camera_module = importlib.import_module(camera_module)
-        camera = getattr(camera_module, "Camera")(**camera_kwargs)
-        return Scanner(cnc, gimbal, camera)
+        if "cameras" in scanner_config:
+            cameras = {}
+            offsets = {}
+            for camera_config in scanner_config["cameras"]:
+                name = camera_config["name"]
+                cameras[name] = self.load_camera(camera_config)
+                if "offset" in camera_config:
+                    offsets[name] = list(camera_config["offset"])
+            return MultiCameraScanner(cnc, gimbal, cameras, offsets,
+                                      **scanner_config.get("kwargs", {}))
+
+        camera = self.load_camera(scanner_config["camera"])
+        return Scanner(cnc, gimbal, camera, **scanner_config.get("kwargs", {}))
+
+    def load_camera(self, camera_config):
+        camera_module = importlib.import_module(camera_config["module"])
+        return getattr(camera_module, "Camera")(**camera_config["kwargs"])
 
     def run(self, path=None):
         if path is None:
@@ -97,14 +148,20 @@ class Scan(RomiTask):
         metadata = json.loads(luigi.DictParameter().serialize(self.metadata))
 
         output_fileset = self.output().get()
-        scanner.scan(path, output_fileset)
-        output_fileset.set_metadata(metadata)
-        output_fileset.set_metadata("channels", scanner.channels())
+        if not self.resume:
+            clear_fileset(output_fileset)
+        if self.asynchronous:
+            asyncio.run(aio.from_scanner(scanner).scan(path, output_fileset,
+                                                       resume=self.resume))
+        else:
+            scanner.scan(path, output_fileset, resume=self.resume)
+        output_fileset.set_metadata({**metadata, "channels": scanner.channels()})
 
 
 class VirtualScan(Scan):
     load_scene = luigi.BoolParameter(default=False)
     scene_file_id = luigi.Parameter(default="")
+    use_scene_cache = luigi.BoolParameter(default=True)
 
     use_palette = luigi.BoolParameter(default=False)
     use_hdri = luigi.BoolParameter(default=False)
@@ -128,17 +185,20 @@ class VirtualScan(Scan):
             requires["scene"] = self.scene_fileset()
         return requires
 
-    def load_scanner(self):
+    def create_scanner(self):
         scanner_config = json.loads(
             luigi.DictParameter().serialize(self.scanner))
 
-        obj_fileset = self.input()["object"].get()
         if self.load_scene:
             scene_fileset = self.input()["scene"].get()
             for f in scene_fileset.get_files():
                 logger.debug(f.id)
-            self.tmpdir = io.tmpdir_from_fileset(scene_fileset)
-            scanner_config["scene"] = os.path.join(self.tmpdir.name,
+            if self.use_scene_cache:
+                scene_dir = SceneCache().get(scene_fileset)
+            else:
+                self.tmpdir = io.tmpdir_from_fileset(scene_fileset)
+                scene_dir = self.tmpdir.name
+            scanner_config["scene"] = os.path.join(scene_dir,
                                                    scene_fileset.get_file(
                                                        self.scene_file_id).filename)
 
@@ -146,28 +206,164 @@ class VirtualScan(Scan):
             scanner_config["classes"] = list(
                 VirtualPlantConfig().classes.values())
 
-        vscan = VirtualScanner(**scanner_config)
-        while True:
-            obj_file = random.choice(obj_fileset.get_files())
-            if "obj" in obj_file.filename:
-                break
+        return VirtualScanner(**scanner_config)
+
+    def chooser(self):
+        """Random generator of the object, palette and background choices,
+        seeded by the seed of the scanner if it is set"""
+        if not hasattr(self, "_chooser"):
+            seed = self.scanner.get("seed")
+            self._chooser = random if seed is None else random.Random(seed)
+        return self._chooser
+
+    def choose_file(self, files):
+        return self.chooser().choice(sorted(files, key=lambda f: f.id))
+
+    def get_object_files(self, obj_id=None):
+        """Returns the OBJ file with the given id, or a random one, and its
+        MTL file."""
+        obj_fileset = self.input()["object"].get()
+        if obj_id is not None:
+            obj_file = obj_fileset.get_file(obj_id)
+        else:
+            obj_file = self.choose_file([f for f in obj_fileset.get_files()
+                                         if "obj" in f.filename])
         mtl_file = obj_fileset.get_file(obj_file.id + "_mtl")
-        palette_file = None
-        if self.use_palette:
-            palette_file = random.choice(
-                self.input()["palette"].get().get_files())
+        return obj_file, mtl_file
+
+    def get_palette_file(self, palette_id=None):
+        if not self.use_palette:
+            return None
+        palette_fileset = self.input()["palette"].get()
+        if palette_id is not None:
+            return palette_fileset.get_file(palette_id)
+        return self.choose_file(palette_fileset.get_files())
+
+    def get_background_file(self, hdri_id=None):
+        if not self.use_hdri:
+            return None
+        hdri_fileset = self.input()["hdri"].get()
+        if hdri_id is not None:
+            return hdri_fileset.get_file(hdri_id)
+        return self.choose_file(hdri_fileset.get_files())
+
+    def load_scanner(self):
+        output_fileset = self.output().get()
+        # A resumed scan uses the object and background of the interrupted one
+        choice = {}
+        if self.resume:
+            choice = output_fileset.get_metadata("virtual_scan") or {}
+
+        vscan = self.create_scanner()
+        obj_file, mtl_file = self.get_object_files(choice.get("object"))
+        palette_file = self.get_palette_file(choice.get("palette"))
         vscan.load_object(obj_file, mtl=mtl_file, palette=palette_file)
 
-        if self.use_hdri:
-            hdri_fileset = self.input()["hdri"].get()
-            hdri_file = random.choice(hdri_fileset.get_files())
+        hdri_file = self.get_background_file(choice.get("background"))
+        if hdri_file is not None:
             vscan.load_background(hdri_file)
 
-        bb = vscan.get_bounding_box()
-        self.output().get().set_metadata("bounding_box", bb)
+        output_fileset.set_metadata({
+            "bounding_box": vscan.get_bounding_box(),
+            "virtual_scan": {
+                "object": obj_file.id,
+                "palette": None if palette_file is None else palette_file.id,
+                "background": None if hdri_file is None else hdri_file.id
+            }
+        })
         return vscan
 
 
+class VirtualScanBatch(VirtualScan):
+    """ A task running several virtual scans with a single virtual scanner,
+    so that Blender and the scene are only started and loaded once.
+
+    Module: romiscan.tasks.scan
+    Default upstream tasks: None
+
+    Parameters
+    ----------
+    jobs : ListParameter
+        list of jobs, each job is a dictionary with keys:
+            - "scan_id": id of the scan written in the database (required)
+            - "object": id of the OBJ file (random if not set)
+            - "palette": id of the palette file (random if not set)
+            - "background": id of the HDRI file (random if not set)
+            - "path": path configuration with the keys of ScanPath (ScanPath
+              if not set)
+        Jobs whose scan is finished are skipped, interrupted ones are
+        resumed if resume is set, and started over otherwise.
+
+    """
+    jobs = luigi.ListParameter(default=[])
+
+    def job_target(self, job, create=False):
+        """Target of the job, None if its scan does not exist and create is
+        not set"""
+        scan = DatabaseConfig().scan.db.get_scan(job["scan_id"], create=create)
+        if scan is None:
+            return None
+        return FilesetTarget(scan, "images")
+
+    def output(self):
+        targets = [self.job_target(job) for job in self.jobs]
+        return [target for target in targets if target is not None]
+
+    def complete(self):
+        for job in self.jobs:
+            target = self.job_target(job)
+            if target is None or not target.exists() or not scan_finished(target.get()):
+                return False
+        return True
+
+    def run(self):
+        jobs = json.loads(luigi.ListParameter().serialize(self.jobs))
+        metadata = json.loads(luigi.DictParameter().serialize(self.metadata))
+
+        vscan = self.create_scanner()
+        loaded_object = None
+        loaded_background = None
+        for job in jobs:
+            target = self.job_target(job, create=True)
+            if target.exists() and scan_finished(target.get()):
+                logger.info("skipping %s, already scanned"%job["scan_id"])
+                continue
+            output_fileset = target.get()
+            choice = {}
+            if self.resume:
+                choice = output_fileset.get_metadata("virtual_scan") or {}
+            else:
+                clear_fileset(output_fileset)
+            choice = {**choice, **{k: job[k] for k in ["object", "palette", "background"]
+                                   if k in job}}
+
+            obj_file, mtl_file = self.get_object_files(choice.get("object"))
+            palette_file = self.get_palette_file(choice.get("palette"))
+            object_key = (obj_file.id, None if palette_file is None else palette_file.id)
+            if object_key != loaded_object:
+                vscan.load_object(obj_file, mtl=mtl_file, palette=palette_file)
+                loaded_object = object_key
+
+            hdri_file = self.get_background_file(choice.get("background"))
+            if hdri_file is not None and hdri_file.id != loaded_background:
+                vscan.load_background(hdri_file)
+                loaded_background = hdri_file.id
+
+            path = self.get_path(job.get("path"))
+            output_fileset.set_metadata("virtual_scan", {
+                "object": obj_file.id,
+                "palette": object_key[1],
+                "background": None if hdri_file is None else hdri_file.id
+            })
+            vscan.scan_count = 0
+            vscan.scan(path, output_fileset, resume=self.resume)
+            output_fileset.set_metadata({
+                **metadata,
+                "channels": vscan.channels(),
+                "bounding_box": vscan.get_bounding_box()
+            })
+
+
 class CalibrationScan(RomiTask):
     """ A task for running a scan, real or virtual, with a calibration path.
 
@@ -180,7 +376,10 @@ class CalibrationScan(RomiTask):
     metadata : DictParameter
         metadata for the scan
     scanner : DictParameter
-        scanner hardware configuration (TODO: see hardware documentation)
+        scanner hardware configuration (TODO: see hardware documentation).
+        Instead of a single "camera", a list of "cameras" can be given, each
+        with a "name", a "module", "kwargs" and an optional "offset"
+        [dx, dy, dz, dpan, dtilt] (see ``MultiCameraScanner``).
     path : DictParameter
         scanner path configuration (TODO: see hardware documentation)
     n_line : int ?
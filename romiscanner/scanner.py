@@ -26,7 +26,9 @@ import os
 import numpy as np
 import math
 import time
-from typing import List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 
 from . import path
 from .units import *
@@ -34,35 +36,312 @@ from .hal import *
 
 from romidata.db import Fileset
 
+# Distance (mm) at which a reported position reaches a fly-by target: the
+# controller reports step-quantized positions which may stop short of it
+CROSSING_TOLERANCE = 0.01
+# Margin (s) added to the expected duration of a fly-by segment
+CROSSING_TIMEOUT = 10.
+
+def angle_difference(a: Deg, b: Deg) -> Deg:
+    """Shortest rotation from a to b, in [-180, 180)"""
+    return (b - a + 180) % 360 - 180
+
 class Scanner(AbstractScanner):
+    """
+    Scanner made of a CNC, a gimbal and a camera.
+
+    Pan angles are unwrapped, if the gimbal pan can turn beyond a single
+    turn, so that the gimbal always takes the shortest rotation to the next
+    pose, within pan_limits [min, max] if given (e.g.
+    for a gimbal whose cable only allows a limited rotation). The pose
+    metadata keeps the angles of the path.
+
+    If a feed rate (mm/min) is given, path elements reached along an arc
+    (e.g. on circles) are moved to with arc moves at this feed rate if the
+    CNC supports them. Otherwise, all moves are rapid straight moves.
+
+    With flyby (which requires the feed rate), paths without exact poses
+    are scanned without stopping if the CNC supports continuous moves: the
+    CNC follows the path at the feed rate, keeping lookahead moves queued,
+    the gimbal follows the position reported by the CNC, and the camera is
+    triggered when the reported position crosses each target. The pose of each shot is extrapolated
+    from the last position reports at the time of the trigger. Fly-by scans
+    need a camera that grabs quickly, e.g. with deferred transfers.
+    """
     def __init__(self, cnc: AbstractCNC,
                     gimbal: AbstractGimbal,
                     camera: AbstractCamera,
-                    waiting_time: float=1.):
+                    waiting_time: float=1.,
+                    flyby: bool=False,
+                    feed: float=None,
+                    lookahead: int=4,
+                    poll_interval: float=0.02,
+                    unwrap_pan: bool=True,
+                    pan_limits: List[Deg]=None):
         super().__init__()
         self.cnc = cnc
         self.gimbal = gimbal
         self.camera = camera
         self.waiting_time = waiting_time # time to wait for stabilization after setting position
+        if flyby and feed is None:
+            raise ValueError("Fly-by scans need a feed rate")
+        self.flyby = flyby
+        self.feed = feed
+        self.lookahead = lookahead
+        self.poll_interval = poll_interval
+        self.unwrap_pan = unwrap_pan
+        self.pan_limits = pan_limits
+        self.last_pan = None # last pan sent to the gimbal
 
     def get_position(self) -> path.Pose:
         x,y,z = self.cnc.get_position()
         pan,tilt = self.gimbal.get_position()
         return path.Pose(x,y,z,pan,tilt)
 
+    def gimbal_pan(self, pan: Deg) -> Deg:
+        """Pan angle sent to the gimbal, the nearest to the last one"""
+        if not self.unwrap_pan or not self.gimbal.multi_turn():
+            return pan
+        if self.last_pan is None:
+            self.last_pan = self.gimbal.get_position()[0]
+        self.last_pan = path.nearest_pan(self.last_pan, pan, self.pan_limits)
+        return self.last_pan
+
     def set_position(self, pose: path.Pose) -> None:
         if self.cnc.async_enabled():
             self.cnc.moveto_async(pose.x, pose.y, pose.z)
-            self.gimbal.moveto_async(pose.pan, pose.tilt)
+            self.gimbal.moveto_async(self.gimbal_pan(pose.pan), pose.tilt)
             self.cnc.wait()
             self.gimbal.wait()
         else:
-            self.cnc.moveto(x, y, z)
-            self.gimbal.moveto(pose.pan, pose.tilt)
+            self.cnc.moveto(pose.x, pose.y, pose.z)
+            self.gimbal.moveto(self.gimbal_pan(pose.pan), pose.tilt)
+        time.sleep(self.waiting_time)
+
+    def set_position_arc(self, pose: path.Pose, arc: path.Arc) -> None:
+        if self.feed is None or not self.cnc.arc_enabled():
+            self.set_position(pose)
+            return
+        self.cnc.arcto_async(pose.x, pose.y, pose.z, arc, self.feed)
+        self.gimbal.moveto_async(self.gimbal_pan(pose.pan), pose.tilt)
+        self.cnc.wait()
+        self.gimbal.wait()
         time.sleep(self.waiting_time)
 
     def grab(self, idx: int, metadata: dict=None):
         return self.camera.grab(idx, metadata)
 
+    def trigger(self, idx: int, metadata: dict=None):
+        return self.camera.trigger(idx, metadata)
+
+    def fetch(self, handle) -> DataItem:
+        return self.camera.fetch(handle)
+
+    def use_flyby(self, path: path.Path) -> bool:
+        return (self.flyby and self.cnc.continuous_enabled()
+                and not any(x.exact_pose for x in path))
+
+    def home(self) -> None:
+        if not self.cnc.is_homed():
+            self.cnc.home()
+        self.last_pan = None
+
+    def scan(self, path: path.Path, fileset: Fileset, prefetch: int=0, resume: bool=False) -> None:
+        if self.use_flyby(path): # Writes must not delay the triggers
+            prefetch = None
+        super().scan(path, fileset, prefetch=prefetch, resume=resume)
+
+    def _iter_shots(self, path: path.Path, skip):
+        if self.use_flyby(path):
+            return self._iter_flyby(path, skip)
+        return super()._iter_shots(path, skip)
+
+    def _iter_flyby(self, scan_path: path.Path, skip):
+        poses = [self.get_target_pose(x) for x in scan_path]
+        arcs = [x.arc if self.cnc.arc_enabled() else None for x in scan_path]
+        self.set_position(poses[0])
+        queued = 1
+        reports = [self.cnc.poll_position()]
+        for i, target in enumerate(poses):
+            t0 = time.time()
+            while queued < min(i + 1 + self.lookahead, len(poses)):
+                p = poses[queued]
+                if arcs[queued] is not None:
+                    self.cnc.arcto_async(p.x, p.y, p.z, arcs[queued], self.feed)
+                else:
+                    self.cnc.moveto_continuous(p.x, p.y, p.z, self.feed)
+                queued += 1
+            if i > 0:
+                self.wait_crossing(poses[i-1], target, reports,
+                                   last=(i == len(poses) - 1))
+            if i in skip: # Already scanned, the CNC keeps moving
+                self.inc_count()
+                continue
+            t = time.time()
+            x, y, z = self.extrapolate_position(reports, t)
+            pan, tilt = self.gimbal.get_position()
+            pose = path.Pose(x, y, z, pan % 360, tilt)
+            metadata = {"approximate_pose": [x, y, z, pan % 360, tilt], "timestamp": t}
+            data_item = self.grab(self.inc_count(), metadata=metadata)
+            yield data_item, pose, {"move": t - t0, "grab": time.time() - t}
+        self.cnc.wait()
+        t0 = time.time()
+        data_items = self.retrieve()
+        for data_item in data_items:
+            yield data_item, None, {"retrieve": time.time() - t0}
+
+    def wait_crossing(self, start: path.Pose, target: path.Pose, reports: list,
+                      last: bool=False) -> None:
+        """Polls the CNC position until it crosses the plane through the target
+        orthogonal to the segment from start, or is within CROSSING_TOLERANCE
+        of the target (or the CNC is idle, for the last target of the path),
+        the gimbal following the progress along the segment. Raises a
+        ScannerError if the CNC is in alarm or takes too long."""
+        a = np.array([start.x, start.y, start.z], dtype=float)
+        b = np.array([target.x, target.y, target.z], dtype=float)
+        d = b - a
+        length = np.dot(d, d)
+        # Arcs between targets are at most pi/2 times longer than the chord
+        timeout = CROSSING_TIMEOUT + 60 * 2 * math.sqrt(length) / self.feed
+        deadline = time.time() + timeout
+        while True:
+            t, pos = self.cnc.poll_position()
+            reports.append((t, pos))
+            del reports[:-2]
+            state = self.cnc.reported_state()
+            if state is not None and state.startswith("Alarm"):
+                raise ScannerError("CNC alarm during the fly-by scan")
+            s = 1. if length == 0 else np.dot(np.array(pos) - a, d) / length
+            if (s >= 1 or np.linalg.norm(np.array(pos) - b) <= CROSSING_TOLERANCE
+                    or (last and state == "Idle")):
+                return
+            if time.time() > deadline:
+                raise ScannerError("Target (%.3f, %.3f, %.3f) not reached after %.1f s"%(
+                    target.x, target.y, target.z, timeout))
+            if self.gimbal.async_enabled():
+                s = max(s, 0.)
+                pan = start.pan + s * angle_difference(start.pan, target.pan)
+                self.gimbal.moveto_async(self.gimbal_pan(pan),
+                                         start.tilt + s * (target.tilt - start.tilt))
+            time.sleep(self.poll_interval)
+
+    def dry_run(self, scan_path: path.Path) -> dict:
+        """
+        Compares the rotation of the gimbal along the path, from its current
+        position, with and without pan unwrapping. Nothing is moved. Pan
+        angles are not unwrapped if the gimbal is limited to a single turn
+        (nothing is saved).
+        """
+        start = self.gimbal.get_position()[0]
+        pans = [x.pan for x in scan_path if x.pan is not None]
+        if self.unwrap_pan and self.gimbal.multi_turn():
+            unwrapped = path.unwrap_pan(pans, start, self.pan_limits)
+        else:
+            unwrapped = pans
+        def travel(pans):
+            return sum(abs(b - a) for a, b in zip([start] + pans, pans))
+        res = {"pan_travel": travel(unwrapped), "wrapped_pan_travel": travel(pans)}
+        res["saved_pan_travel"] = res["wrapped_pan_travel"] - res["pan_travel"]
+        logger.info("pan travel: %.1f deg, %.1f deg saved by unwrapping"%(
+            res["pan_travel"], res["saved_pan_travel"]))
+        return res
+
+    def extrapolate_position(self, reports: list, t: float) -> List[float]:
+        """Position at time t, from the velocity given by the last two reports"""
+        t1, p1 = reports[-1]
+        if len(reports) < 2 or reports[-2][0] == t1:
+            return list(p1)
+        t0, p0 = reports[-2]
+        p0, p1 = np.array(p0), np.array(p1)
+        return list(p1 + (p1 - p0) * (t - t1) / (t1 - t0))
+
     def channels(self) -> List[str]:
         return self.camera.channels()
+
+    def retrieve(self) -> List[DataItem]:
+        return self.camera.retrieve()
+
+
+class MultiCameraScanner(Scanner):
+    """
+    Scanner with several cameras on the gimbal, all triggered at each pose.
+
+    Cameras are given by name, and each has a fixed offset [dx, dy, dz, dpan,
+    dtilt] from the scanner pose, dx and dy being rotated by the pan angle.
+    The cameras wait on a barrier so that they are triggered together, and
+    the capture and the transfer of each camera run in its own thread. The
+    channels are namespaced as "<camera name>_<channel>", and the metadata
+    of a shot holds the pose and trigger time of each camera.
+    """
+    def __init__(self, cnc: AbstractCNC,
+                    gimbal: AbstractGimbal,
+                    cameras: Dict[str, AbstractCamera],
+                    offsets: Dict[str, List[float]]=None,
+                    **kwargs):
+        super().__init__(cnc, gimbal, None, **kwargs)
+        self.cameras = cameras
+        self.offsets = {name: [0, 0, 0, 0, 0] for name in cameras}
+        if offsets is not None:
+            self.offsets.update(offsets)
+        self.executor = ThreadPoolExecutor(max_workers=len(cameras))
+        self.pending = {} # shots waiting for deferred transfers
+
+    def camera_pose(self, name: str, pose: List[float]) -> List[float]:
+        x, y, z, pan, tilt = pose
+        dx, dy, dz, dpan, dtilt = self.offsets[name]
+        c, s = math.cos(math.radians(pan)), math.sin(math.radians(pan))
+        return [x + c*dx - s*dy, y + s*dx + c*dy, z + dz, pan + dpan, tilt + dtilt]
+
+    def add_channels(self, data_item: DataItem, name: str, camera_item: DataItem) -> None:
+        for c, channel in camera_item.channels.items():
+            if channel.encoded is not None:
+                data_item.add_channel("%s_%s"%(name, c), encoded=channel.encoded, fmt=channel.fmt)
+            else:
+                data_item.add_channel("%s_%s"%(name, c), channel.data)
+
+    def grab(self, idx: int, metadata: dict=None):
+        return self.fetch(self.trigger(idx, metadata))
+
+    def trigger(self, idx: int, metadata: dict=None):
+        metadata = dict(metadata) if metadata is not None else {}
+        barrier = threading.Barrier(len(self.cameras))
+
+        def trigger_camera(name):
+            barrier.wait()
+            t = time.time()
+            return name, t, self.cameras[name].trigger(idx)
+
+        results = list(self.executor.map(trigger_camera, self.cameras))
+        metadata["camera_timestamps"] = {name: t for name, t, _ in results}
+        pose = metadata.get("pose", metadata.get("approximate_pose"))
+        if pose is not None:
+            metadata["camera_poses"] = {name: self.camera_pose(name, pose)
+                                        for name in self.cameras}
+        return idx, metadata, [(name, handle) for name, _, handle in results]
+
+    def fetch(self, handle) -> DataItem:
+        idx, metadata, handles = handle
+        results = list(self.executor.map(
+            lambda x: (x[0], self.cameras[x[0]].fetch(x[1])), handles))
+
+        data_item = DataItem(idx, metadata)
+        for name, camera_item in results:
+            self.add_channels(data_item, name, camera_item)
+        if any(len(camera_item.channels) == 0 for _, camera_item in results):
+            # Completed by retrieve
+            self.pending[idx] = data_item
+            return DataItem(idx, metadata)
+        return data_item
+
+    def channels(self) -> List[str]:
+        return ["%s_%s"%(name, c) for name, camera in self.cameras.items()
+                for c in camera.channels()]
+
+    def retrieve(self) -> List[DataItem]:
+        retrieved = self.executor.map(lambda name: (name, self.cameras[name].retrieve()),
+                                      self.cameras)
+        for name, camera_items in retrieved:
+            for camera_item in camera_items:
+                self.add_channels(self.pending[camera_item.idx], name, camera_item)
+        pending, self.pending = self.pending, {}
+        return [pending[idx] for idx in sorted(pending)]
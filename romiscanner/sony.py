@@ -28,39 +28,60 @@ import requests
 import time
 import json
 import subprocess
+import threading
 import numpy as np
 from io import BytesIO
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 from . import hal, error
 from .hal import DataItem
 import tempfile
 from .units import *
+from .log import logger
 
 CAMERA_FUNCTION_SHOOT = 'Remote Shooting'
 CAMERA_FUNCTION_TRANSFER = 'Contents Transfer'
+LONG_POLLING_TIMEOUT = 60
 
 class SonyCamError(Exception):
     def __init__(self, message):
         self.message = message
 
 class SonyCamAPI(object):
-    def __init__(self, device_ip, api_port, timeout=2):
+    """
+    Sony Camera Remote API client. Calls go through a keep-alive HTTP
+    session. With event_polling, a background thread long-polls getEvent
+    and keeps the camera status up to date, status waits then block on a
+    condition instead of polling the camera.
+    """
+    def __init__(self, device_ip, api_port, timeout=2, event_polling=True):
         self.device_ip = device_ip
         self.api_port = api_port
         self.api_url = 'http://' + device_ip + ':' + api_port + '/sony/'
         self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+        self.status = None
+        self.status_condition = threading.Condition()
+        self.event_thread = None
         method_types = self.get_method_types()
         self.supported_methods = [x[0] for x in method_types]
-
-    def api_call(self, endpoint, method, params=[], version='1.0'):
-        request_result = requests.post(self.api_url + endpoint,
+        if event_polling:
+            self.start_event_polling()
+
+    def api_call(self, endpoint, method, params=[], version='1.0', session=None, timeout=None):
+        if session is None:
+            session = self.session
+        if timeout is None:
+            timeout = self.timeout
+        request_result = session.post(self.api_url + endpoint,
               data=json.dumps({
                   'method': method,
                   'params': params,
                   'id':1,
                   'version': version
               }),
-              timeout=self.timeout)
+              timeout=timeout)
         res = json.loads(request_result.content.decode('utf-8'))
         if 'error' in res:
             err = res['error']
@@ -78,17 +99,78 @@ class SonyCamAPI(object):
     def start_rec_mode(self):
         return self.api_call("camera", "startRecMode")
 
-    def take_picture(self):
+    def start_event_polling(self):
+        self.polling = True
+        self.event_thread = threading.Thread(target=self.poll_events, daemon=True)
+        self.event_thread.start()
+
+    def stop_event_polling(self):
+        self.polling = False
+
+    def poll_events(self):
+        session = requests.Session()
+        long_polling = False # The first call returns the current state at once
+        while self.polling:
+            try:
+                events = self.api_call("camera", "getEvent", [long_polling],
+                                       session=session, timeout=LONG_POLLING_TIMEOUT)
+                long_polling = True
+            except (SonyCamError, requests.exceptions.RequestException, ValueError):
+                # Long polling timeouts and connection errors: poll again
+                long_polling = False
+                time.sleep(0.1)
+                continue
+            self.update_status(events)
+
+    def update_status(self, events):
+        for x in events:
+            if isinstance(x, dict) and 'cameraStatus' in x:
+                with self.status_condition:
+                    self.status = x['cameraStatus']
+                    self.status_condition.notify_all()
+                return x['cameraStatus']
+        return None
+
+    def invalidate_status(self):
+        """Forgets the cached status after a call changing the camera state,
+        so that the next wait is for a fresh status"""
+        with self.status_condition:
+            self.status = None
+
+    def wait_for_status(self, statuses, timeout=LONG_POLLING_TIMEOUT):
+        """
+        Waits until the camera status is one of statuses and returns it
+        """
+        deadline = time.time() + timeout
         while True:
-            status = self.get_camera_status()
-            if status == 'ContentsTransfer':
-                raise SonyCamError('Camera is in content transfer mode, cannot take picture')
-            elif status == 'IDLE':
-                break
-            else:
+            if self.event_thread is None:
+                status = self.get_camera_status()
+                if status in statuses:
+                    return status
                 time.sleep(0.1)
+            else:
+                with self.status_condition:
+                    self.status_condition.wait_for(lambda: self.status in statuses,
+                                                   max(0, min(1, deadline - time.time())))
+                    status = self.status
+                if status in statuses:
+                    return status
+                if status is None and time.time() < deadline:
+                    # No event since the status was invalidated, the change
+                    # may have been reported before: ask the camera
+                    self.update_status(self.get_event())
+                    continue
+            if time.time() >= deadline:
+                raise SonyCamError('Timeout waiting for camera status %s'%(statuses,))
+
+    def take_picture(self):
+        status = self.wait_for_status(['IDLE', 'ContentsTransfer'])
+        if status == 'ContentsTransfer':
+            raise SonyCamError('Camera is in content transfer mode, cannot take picture')
 
-        return self.api_call("camera", "actTakePicture")[0]
+        res = self.api_call("camera", "actTakePicture")[0]
+        self.invalidate_status()
+        return res
 
     def get_available_camera_function(self):
         return self.api_call("camera", "getAvailableCameraFunction")[0]
@@ -97,7 +179,9 @@ class SonyCamAPI(object):
         return self.api_call("camera", "getCameraFunction")[0]
 
     def set_camera_function(self, function):
-        return self.api_call("camera", "setCameraFunction", [function])[0]
+        res = self.api_call("camera", "setCameraFunction", [function])[0]
+        self.invalidate_status()
+        return res
 
     def get_storage_information(self):
         return self.api_call("camera", "getStorageInformation")[0]
@@ -113,12 +197,37 @@ class SonyCamAPI(object):
             "view" : view,
             "sort" : sort}], version="1.3")[0]
 
+    def get_content_count(self, uri):
+        """Number of still pictures in the storage. The camera must be in
+        content transfer mode."""
+        return self.api_call("avContent", "getContentCount", [{
+            "uri" : uri,
+            "type" : ["still"],
+            "view" : "flat"}], version="1.2")[0]["count"]
+
+    def get_latest_contents(self, uri, count):
+        """
+        Returns the count latest contents of the storage, oldest first.
+        The camera must be in content transfer mode.
+        """
+        contents = []
+        while len(contents) < count:
+            page = self.get_content_list(count=min(100, count - len(contents)),
+                                         uri=uri, stIdx=len(contents))
+            if len(page) == 0:
+                break
+            contents.extend(page)
+        if len(contents) < count:
+            raise SonyCamError('Expected %i contents, found %i'%(count, len(contents)))
+        return contents[::-1]
+
     def get_camera_status(self):
-        events = self.get_event()
-        for x in events:
-            if 'cameraStatus' in x:
-                return x['cameraStatus']
-        raise SonyCamError('Could not get camera status')
+        if self.event_thread is not None and self.status is not None:
+            return self.status
+        status = self.update_status(self.get_event())
+        if status is None:
+            raise SonyCamError('Could not get camera status')
+        return status
 
     def get_available_api_list(self):
         return self.api_call("camera", "getAvailableApiList")[0]
@@ -137,8 +246,7 @@ class SonyCamAPI(object):
                 self.set_camera_function(CAMERA_FUNCTION_SHOOT)
         if 'startRecMode' in self.supported_methods:
             self.start_rec_mode()
-        while not self.get_camera_status() == 'IDLE':
-            continue
+        self.wait_for_status(['IDLE'])
 
     def setup_camera(self, params):
         if 'FNumber' in params:
@@ -161,8 +269,7 @@ class SonyCamAPI(object):
             camera_function = self.get_camera_function()
             if camera_function != CAMERA_FUNCTION_TRANSFER:
                 self.set_camera_function(CAMERA_FUNCTION_TRANSFER)
-        while not self.get_camera_status() == 'ContentsTransfer':
-            continue
+        self.wait_for_status(['ContentsTransfer'])
 
     def get_available_shoot_mode(self):
         return self.api_call("camera", "getAvailableShootMode")[1]
@@ -170,6 +277,15 @@ class SonyCamAPI(object):
     def set_shoot_mode(self, mode):
         return self.api_call("camera", "setShootMode", [mode])
 
+    def start_liveview(self, size=None):
+        """Starts the liveview stream and returns its URL"""
+        if size is not None:
+            return self.api_call("camera", "startLiveviewWithSize", [size])[0]
+        return self.api_call("camera", "startLiveview")[0]
+
+    def stop_liveview(self):
+        return self.api_call("camera", "stopLiveview")
+
     def start_movie_rec(self):
         return self.api_call("camera", "startMovieRec")
 
@@ -195,17 +311,193 @@ class SonyCamAPI(object):
             print(f)
         return images
 
+class LiveviewStream(object):
+    """
+    Reads the liveview stream of the camera in a background thread, keeping
+    the latest JPEG frame and the time it was received. Frames are only
+    decoded when requested.
+    """
+    def __init__(self, url, timeout=10):
+        self.frame = None
+        self.timestamp = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.response = requests.get(url, stream=True, timeout=timeout)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def read(self, n):
+        data = b''
+        while len(data) < n:
+            x = self.response.raw.read(n - len(data))
+            if not x:
+                raise SonyCamError('Liveview stream closed')
+            data += x
+        return data
+
+    def run(self):
+        try:
+            while self.running:
+                # Common header: start byte, payload type, sequence number, timestamp
+                common_header = self.read(8)
+                if common_header[0] != 0xFF:
+                    raise SonyCamError('Unexpected liveview packet')
+                # Payload header: start code, payload size (3 bytes), padding size
+                payload_header = self.read(128)
+                size = int.from_bytes(payload_header[4:7], 'big')
+                padding = payload_header[7]
+                data = self.read(size)
+                self.read(padding)
+                if common_header[1] == 0x01: # JPEG frame
+                    with self.condition:
+                        self.frame = data
+                        self.timestamp = time.time()
+                        self.condition.notify_all()
+        finally:
+            self.response.close()
+
+    def get_frame(self, after=0, timeout=5):
+        """
+        Returns the latest JPEG frame received after the given time.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.timestamp > after, timeout):
+                raise SonyCamError('No liveview frame received')
+            return self.frame, self.timestamp
+
+    def stop(self):
+        self.running = False
+
+class AdbTransfer(object):
+    """
+    Transfers pictures from the camera with the Android debug bridge (ADB
+    shell must be enabled on the camera). The connection and an adb shell
+    are kept open, new files are listed incrementally and pulled in batches
+    into a private directory. With start_background, new files are pulled
+    periodically during the scan.
+
+    As SD card file systems store coarse modification times (2 s on FAT),
+    each listing includes the files modified since a minute before the
+    previous one, the known files being ignored.
+    """
+    def __init__(self, device_ip, directory='/sdcard/DCIM/100MSDCF'):
+        subprocess.run(['adb', 'connect', device_ip], check=True)
+        self.serial = device_ip if ':' in device_ip else device_ip + ':5555'
+        self.directory = directory
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.shell = subprocess.Popen(['adb', '-s', self.serial, 'shell'],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      universal_newlines=True, bufsize=1)
+        self.lock = threading.Lock()
+        self.background = None
+        self.stopped = threading.Event()
+        self.to_pull = []
+        self.pulled = []
+        self.listed_at = time.time()
+        self.known = set(self.run_shell('ls -1 %s'%self.directory))
+
+    def run_shell(self, cmd):
+        """Runs a command in the adb shell and returns its output lines"""
+        self.shell.stdin.write('%s 2>/dev/null; echo __END__\n'%cmd)
+        self.shell.stdin.flush()
+        lines = []
+        while True:
+            line = self.shell.stdout.readline()
+            if line == '':
+                raise SonyCamError('adb shell closed')
+            line = line.strip()
+            if line == '__END__':
+                return lines
+            if line != '':
+                lines.append(line)
+
+    def update(self):
+        """Lists the files added since the last call"""
+        t = time.time()
+        minutes = int((t - self.listed_at) / 60) + 2
+        files = self.run_shell('find %s -type f -mmin -%i'%(self.directory, minutes))
+        self.listed_at = t
+        files = sorted(os.path.basename(f) for f in files)
+        new = [f for f in files if f not in self.known]
+        self.known.update(new)
+        self.to_pull.extend(new)
+        return new
+
+    def pull(self):
+        """Pulls all listed files in a single adb call"""
+        if len(self.to_pull) == 0:
+            return
+        sources = [self.directory + '/' + f for f in self.to_pull]
+        subprocess.run(['adb', '-s', self.serial, 'pull'] + sources + [self.tmpdir.name],
+                       check=True, stdout=subprocess.DEVNULL)
+        self.pulled.extend(os.path.join(self.tmpdir.name, f) for f in self.to_pull)
+        self.to_pull = []
+
+    def collect(self, count=None, timeout=10):
+        """
+        Returns the local paths of the files pulled since the last call,
+        oldest first, waiting until at least count files are available.
+        """
+        t0 = time.time()
+        while True:
+            with self.lock:
+                self.update()
+                self.pull()
+                if count is None or len(self.pulled) >= count or time.time() - t0 > timeout:
+                    pulled, self.pulled = self.pulled, []
+                    break
+            time.sleep(0.1)
+        if count is not None and len(pulled) < count:
+            raise SonyCamError('Expected %i new pictures, found %i'%(count, len(pulled)))
+        return pulled
+
+    def start_background(self, interval=1.):
+        self.background_interval = interval
+        self.background = threading.Thread(target=self.run_background, daemon=True)
+        self.background.start()
+
+    def run_background(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                self.update()
+                self.pull()
+            self.stopped.wait(self.background_interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.background is not None:
+            self.background.join()
+        self.shell.stdin.close()
+        self.shell.wait()
+        self.tmpdir.cleanup()
+
 class FlashAirAPIError(Exception):
     def __init__(self, message):
         self.message = message
 
 class FlashAirAPI(object):
-    def __init__(self, host):
+    """
+    FlashAir wifi SD card client. The files present on the card when the
+    client starts are ignored, new pictures are listed from the newest
+    directory only: the directory list is refreshed when that directory
+    holds no new file that was not downloaded yet, e.g. when the camera
+    starts a new directory. Files are downloaded in parallel over a
+    keep-alive session.
+    """
+    def __init__(self, host, workers=4):
         self.host = host
         self.commands_format = "http://%s/command.cgi?%s"
         self.delete_format = "http://%s/upload.cgi?DEL=%s"
         self.path_format = "http://%s%s"
-        requests.get(self.path_format%(self.host, "/"))
+        self.workers = workers
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max(10, workers)))
+        self.directories = None
+        self.seen = set()
+        self.session.get(self.path_format%(self.host, "/"))
+        self.directories = self.list_directories()
+        for directory in self.directories:
+            self.seen.update(self.path(f) for f in self.list_directory(directory))
 
     def format_datetime(self, date, time):
         return date+time #TODO
@@ -214,7 +506,7 @@ class FlashAirAPI(object):
         return attribute #TODO
 
     def get_file_list(self, path):
-        res = requests.get(self.commands_format%(self.host, "op=100&DIR=%s"%path))
+        res = self.session.get(self.commands_format%(self.host, "op=100&DIR=%s"%path))
         res = res.content.split()
         #print(res)
         if res[0] != b'WLANSD_FILELIST':
@@ -234,44 +526,103 @@ class FlashAirAPI(object):
             })
         return files
 
-    def transfer_latest_pictures(self, count=1, tmpdir=None):
+    def list_directories(self):
         dir_list = self.get_file_list('/DCIM')
-        files = []
-        for x in dir_list:
-            if x['filename'] != '100__TSB': #Ignore file from SD card
-                files.extend(self.get_file_list('/DCIM/' + x['filename']))
+        directories = [x['filename'] for x in dir_list
+                       if x['filename'] != '100__TSB'] #Ignore file from SD card
+        directories.sort()
+        return directories
+
+    def list_directory(self, directory):
+        files = self.get_file_list('/DCIM/' + directory)
+        files.sort(key = lambda x: x['filename']) #TODO: sort by date
+        return files
 
-        files.sort(key = lambda x: x['filename'], reverse=True) #TODO: sort by date
-        images = []
-        fnames = []
-        for i in range(count):
-            if i >= len(files):
-                break
-            path = '%s/%s'%(files[i]['directory'],files[i]['filename'])
-            url = self.path_format%(self.host, path)
-            print(url)
-            new_image = imageio.imread(BytesIO(requests.get(url).content), format='jpg')
-            if not(tmpdir): images.append(new_image)
-            else:
-                #print(files[i]['filename'])
-                fname =os.path.join(tmpdir,files[i]['filename'])
-                imageio.imwrite(fname, new_image)
-                fnames.append(fname)
+    def path(self, f):
+        return '%s/%s'%(f['directory'], f['filename'])
+
+    def new_files(self, count):
+        """Files not downloaded yet, oldest first, listed from the newest
+        directories until count files are found"""
+        def unseen(directory):
+            return [f for f in self.list_directory(directory) if self.path(f) not in self.seen]
+
+        if not self.directories:
+            self.directories = self.list_directories()
+            if not self.directories:
+                return []
+        files = unseen(self.directories[-1])
+        if len(files) == 0:
+            self.directories = self.list_directories()
+            files = unseen(self.directories[-1])
+        i = len(self.directories) - 2
+        while len(files) < count and i >= 0:
+            files = unseen(self.directories[i]) + files
+            i -= 1
+        return files
 
-        if not(tmpdir):
-            return images[::-1]
-        else:
-            return fnames
+    def latest_files(self, count=1, timeout=10):
+        """
+        Returns the count latest files that were not downloaded yet, oldest
+        first, waiting for the card to list them.
+        """
+        t0 = time.time()
+        while True:
+            files = self.new_files(count)
+            if len(files) >= count:
+                return files[-count:]
+            if time.time() - t0 > timeout:
+                if not self.directories:
+                    raise FlashAirAPIError("No picture directory in /DCIM")
+                raise FlashAirAPIError("Expected %i new pictures, found %i"%(count, len(files)))
+            time.sleep(0.2)
+
+    def download(self, f):
+        path = self.path(f)
+        url = self.path_format%(self.host, path)
+        logger.debug(url)
+        data = self.session.get(url).content
+        self.seen.add(path)
+        return data
+
+    def transfer_latest_pictures(self, count=1, tmpdir=None, raw=False):
+        """
+        Downloads the count latest pictures, oldest first. Returns the
+        decoded images, the JPEG bytes if raw is set, or the file names if
+        tmpdir is given, the files being written as downloaded.
+        """
+        files = self.latest_files(count)
+
+        def transfer(f):
+            data = self.download(f)
+            if tmpdir:
+                fname = os.path.join(tmpdir, f['filename'])
+                with open(fname, "wb") as out:
+                    out.write(data)
+                return fname
+            if raw:
+                return data
+            return imageio.imread(BytesIO(data), format='jpg')
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(transfer, files))
 
     def delete_all(self):
         files=[]
-        dir_list = self.get_file_list('/DCIM')
-        for x in dir_list:
-            if x['filename'] != '100__TSB': #Ignore file from SD card
-                files.extend(self.get_file_list('/DCIM/' + x['filename']))
+        for x in self.list_directories():
+            files.extend(self.get_file_list('/DCIM/' + x))
 
         for f in files:
-            requests.get(self.delete_format%(self.host,f['directory']+'/'+f['filename']))
+            self.session.get(self.delete_format%(self.host,f['directory']+'/'+f['filename']))
+        self.directories = None
+        self.seen = set()
+
+def read_file(fname):
+    """Reads and removes a downloaded file"""
+    with open(fname, 'rb') as f:
+        data = f.read()
+    os.remove(fname)
+    return data
 
 class Camera(hal.AbstractCamera):
     '''
@@ -284,7 +635,12 @@ class Camera(hal.AbstractCamera):
                 use_adb: bool=False,
                 use_flashair: bool=False,
                 flashair_host: str=None,
-                camera_params: dict=None):
+                camera_params: dict=None,
+                deferred_transfer: bool=False,
+                transfer_workers: int=4,
+                liveview: bool=False,
+                liveview_size: str=None,
+                adb_background: bool=False):
 
         self.sony_cam = SonyCamAPI(device_ip, api_port, timeout=timeout)
         self.postview = postview
@@ -296,6 +652,19 @@ class Camera(hal.AbstractCamera):
             if flashair_host is None:
                 raise SonyCamError("Must provide flashair host IP")
             self.flashair = FlashAirAPI(flashair_host)
+        self.deferred_transfer = deferred_transfer
+        if deferred_transfer and (use_flashair or postview):
+            raise SonyCamError("Deferred transfer is only available with content transfer mode or adb")
+        if use_adb:
+            self.adb = AdbTransfer(device_ip)
+            if adb_background:
+                self.adb.start_background()
+        self.transfer_workers = transfer_workers
+        self.pending = []
+        self.content_count = None # pictures on the card before the pending shots
+        self.liveview = liveview
+        self.liveview_size = liveview_size
+        self.liveview_stream = None
 
         self.camera_params = camera_params
         self.start()
@@ -305,21 +674,44 @@ class Camera(hal.AbstractCamera):
         self.sony_cam.set_shoot_mode("still")
         if self.camera_params is not None:
             self.sony_cam.setup_camera(self.camera_params)
+        if self.liveview:
+            url = self.sony_cam.start_liveview(self.liveview_size)
+            self.liveview_stream = LiveviewStream(url)
+        if self.deferred_transfer and not self.use_adb:
+            self.content_count = self.count_contents()
+
+    def count_contents(self):
+        self.sony_cam.start_transfer_mode()
+        uri = self.sony_cam.get_source_list()[0]['source']
+        count = self.sony_cam.get_content_count(uri)
+        self.sony_cam.start_shoot_mode()
+        return count
 
     def channels(self):
         return ['rgb']
 
     def grab(self, idx: int, metadata: dict=None) -> DataItem:
         data_item = DataItem(idx, metadata)
+        if self.liveview: # Newest liveview frame, without shutter actuation
+            frame, _ = self.liveview_stream.get_frame(after=time.time())
+            data_item.add_channel('rgb', encoded=frame, fmt='jpg')
+            return data_item
+
         res = self.sony_cam.take_picture()
+        if self.deferred_transfer: # Downloaded by retrieve at the end of the scan
+            if len(res) == 0:
+                raise SonyCamError('No picture taken for shot %i'%idx)
+            self.pending.append(data_item)
+            return data_item
         url = res[0]
+        # The JPEG is kept as is, it is only decoded if the image is accessed
         if self.postview: # Download image from postview
-            data = imageio.imread(BytesIO(requests.get(url).content))
+            data = self.sony_cam.session.get(url).content
         elif self.use_adb: # Download using android debug
-            images = self.sony_cam.adb_transfer_pictures(count=1)
-            data = images[0]
+            fname = self.adb.collect(count=1)[-1]
+            data = read_file(fname)
         elif self.use_flashair: # Download on wifi sd card
-            images = self.flashair.transfer_latest_pictures(count=1)
+            images = self.flashair.transfer_latest_pictures(count=1, raw=True)
             data = images[0]
         else: # Download using file transfer mode (not available on all cameras)
             self.sony_cam.start_transfer_mode()
@@ -328,8 +720,67 @@ class Camera(hal.AbstractCamera):
             content = content_list[0]
             content = content['content']['original'][0]
             url = content['url']
-            data = imageio.imread(BytesIO(requests.get(url).content))
+            data = self.sony_cam.session.get(url).content
             self.sony_cam.start_shoot_mode()
 
-        data_item.add_channel('rgb', data)
+        data_item.add_channel('rgb', encoded=data, fmt='jpg')
         return data_item
+
+    def trigger(self, idx: int, metadata: dict=None):
+        """Only the postview download is left to fetch, the other transfers
+        need the camera and are done at once"""
+        if self.liveview or self.deferred_transfer or not self.postview:
+            return self.grab(idx, metadata), None
+        url = self.sony_cam.take_picture()[0]
+        return DataItem(idx, metadata), url
+
+    def fetch(self, handle):
+        data_item, url = handle
+        if url is not None:
+            data_item.add_channel('rgb', encoded=self.sony_cam.session.get(url).content, fmt='jpg')
+        return data_item
+
+    def retrieve(self):
+        """
+        Downloads the pictures taken in deferred transfer mode. The camera
+        switches to content transfer mode once, the latest contents are
+        mapped to the pending shots in capture order and downloaded in
+        parallel. With adb, the new files are pulled in a single batch.
+        As pictures are matched to shots by their order, the number of new
+        pictures on the camera must be the number of pending shots.
+        """
+        if len(self.pending) == 0:
+            return []
+        pending, self.pending = self.pending, []
+
+        if self.use_adb: # Pulled in one batch, or in the background during the scan
+            fnames = self.adb.collect(count=len(pending))
+            if len(fnames) != len(pending):
+                for fname in fnames:
+                    os.remove(fname)
+                raise SonyCamError('Expected %i new pictures, found %i'%(len(pending), len(fnames)))
+            for data_item, fname in zip(pending, fnames):
+                data_item.add_channel('rgb', encoded=read_file(fname), fmt='jpg')
+            return pending
+
+        self.sony_cam.start_transfer_mode()
+        uri = self.sony_cam.get_source_list()[0]['source']
+        count = self.sony_cam.get_content_count(uri)
+        if count != self.content_count + len(pending):
+            self.sony_cam.start_shoot_mode()
+            raise SonyCamError('Expected %i new pictures on the camera, found %i'%(
+                len(pending), count - self.content_count))
+        contents = self.sony_cam.get_latest_contents(uri, len(pending))
+        self.content_count = count
+
+        def download(content):
+            url = content['content']['original'][0]['url']
+            return self.sony_cam.session.get(url).content
+
+        with ThreadPoolExecutor(max_workers=self.transfer_workers) as pool:
+            images = list(pool.map(download, contents))
+        self.sony_cam.start_shoot_mode()
+
+        for data_item, data in zip(pending, images):
+            data_item.add_channel('rgb', encoded=data, fmt='jpg')
+        return pending
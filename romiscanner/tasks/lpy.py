@@ -1,4 +1,6 @@
+import itertools
 import json
+import multiprocessing
 import os
 import random
 import subprocess
@@ -8,6 +10,39 @@ import luigi
 from romidata import RomiTask
 from romiscanner.lpy import LpyFileset
 from romiscanner.configs.lpy import VirtualPlantConfig
+from romiscanner.log import logger
+
+
+def derive_plant(lsystem):
+    """Runs the L-system derivation and returns the PlantGL scene of the
+    final interpretation."""
+    from openalea.plantgl import all
+
+    for lstring in lsystem:
+        t = all.PglTurtle()
+        lsystem.turtle_interpretation(lstring, t)
+    return t.getScene()
+
+
+def export_plant(scene, fname, classes):
+    """Saves a PlantGL scene as an OBJ file split by material.
+
+    Parameters
+    ----------
+    scene : openalea.plantgl.all.Scene
+        scene to export
+    fname : str
+        path of the OBJ file, the MTL file is written next to it
+    classes : str
+        JSON mapping of material ids to class names
+    """
+    scene.save(fname)
+    subprocess.run(["romi_split_by_material", "--", "--classes", classes, fname, fname], check=True)
+    subprocess.run(["romi_clean_mesh", "--", fname, fname], check=True)
+
+
+def serialized_classes():
+    return luigi.DictParameter().serialize(VirtualPlantConfig().classes).replace(" ", "")
 
 
 class VirtualPlant(RomiTask):
@@ -19,7 +54,6 @@ class VirtualPlant(RomiTask):
 
     def run(self):
         from openalea import lpy
-        from openalea.plantgl import all
 
         lpy_globals = json.loads(luigi.DictParameter().serialize(self.lpy_globals))
 
@@ -31,22 +65,127 @@ class VirtualPlant(RomiTask):
 
             lsystem = lpy.Lsystem(tmp_filename, globals=lpy_globals)
             # lsystem.context().globals()["SEED"] = self.seed
-            for lstring in lsystem:
-                t = all.PglTurtle()
-                lsystem.turtle_interpretation(lstring, t)
-            scene = t.getScene()
+            scene = derive_plant(lsystem)
 
             output_file = self.output_file()
             fname = os.path.join(tmpdir, "plant.obj")
-            scene.save(fname)
-            classes = luigi.DictParameter().serialize(VirtualPlantConfig().classes).replace(" ", "")
-            subprocess.run(["romi_split_by_material", "--", "--classes", classes, fname, fname], check=True)
-            subprocess.run(["romi_clean_mesh", "--", fname, fname], check=True)
+            export_plant(scene, fname, serialized_classes())
             output_file.import_file(fname)
 
             output_mtl_file = self.output().get().create_file(output_file.id + "_mtl")
             output_mtl_file.import_file(fname.replace("obj", "mtl"))
 
-        for m in self.metadata:
-            m_val = lsystem.context().globals()[m]
-            output_file.set_metadata(m, m_val)
\ No newline at end of file
+        output_file.set_metadata({m: lsystem.context().globals()[m]
+                                  for m in self.metadata})
+
+
+# Per worker state of VirtualPlantBatch: the L-system source and a Lsystem
+# object are kept for the lifetime of the worker process.
+_worker_lsystem = None
+_worker_code = None
+
+
+def _init_batch_worker(lpy_filename):
+    global _worker_lsystem, _worker_code
+    from openalea import lpy
+
+    with open(lpy_filename) as f:
+        _worker_code = f.read()
+    _worker_lsystem = lpy.Lsystem()
+
+
+def _generate_batch_plant(args):
+    name, lpy_globals, outdir, classes, metadata = args
+    # Globals are read by the module level code of the L-system (e.g. SEED),
+    # so the code is set again with each plant's globals.
+    _worker_lsystem.set(_worker_code, lpy_globals)
+    scene = derive_plant(_worker_lsystem)
+    fname = os.path.join(outdir, "%s.obj"%name)
+    export_plant(scene, fname, classes)
+
+    lsystem_globals = _worker_lsystem.context().globals()
+    values = {m: lsystem_globals[m] for m in metadata if m in lsystem_globals}
+    return name, fname, values
+
+
+class VirtualPlantBatch(RomiTask):
+    """ A task generating many virtual plants from one lpy file across a
+    process pool. All plants are written to a single fileset.
+
+    Module: romiscanner.tasks.lpy
+    Default upstream tasks: LpyFileset
+
+    Parameters
+    ----------
+    lpy_file_id : Parameter
+        id of the lpy file in the upstream fileset
+    lpy_globals : ListParameter
+        list of globals dictionaries, one per configuration
+    lpy_globals_grid : DictParameter
+        globals given as lists of values, every combination is added to the
+        configurations of ``lpy_globals``
+    n_plants : IntParameter
+        number of plants generated for each configuration
+    seed : IntParameter
+        base seed, plant number ``i`` gets ``SEED = seed + i`` unless SEED
+        is set in its globals
+    n_workers : IntParameter
+        number of worker processes, defaults to the number of CPUs
+    metadata : ListParameter
+        lpy globals stored as metadata of each plant
+    """
+    upstream_task = LpyFileset
+    lpy_file_id = luigi.Parameter()
+    lpy_globals = luigi.ListParameter(default=[{}])
+    lpy_globals_grid = luigi.DictParameter(default={})
+    n_plants = luigi.IntParameter(default=1)
+    seed = luigi.IntParameter(default=0)
+    n_workers = luigi.IntParameter(default=0)
+    metadata = luigi.ListParameter(default=["angles", "internodes"])
+
+    def configurations(self):
+        configs = json.loads(luigi.ListParameter().serialize(self.lpy_globals))
+        grid = json.loads(luigi.DictParameter().serialize(self.lpy_globals_grid))
+        if len(grid) > 0:
+            keys = sorted(grid.keys())
+            configs = [{**c, **dict(zip(keys, values))}
+                       for c in configs
+                       for values in itertools.product(*[grid[k] for k in keys])]
+        plants = []
+        for c in configs:
+            for _ in range(self.n_plants):
+                plant_globals = dict(c)
+                if "SEED" not in plant_globals:
+                    plant_globals["SEED"] = self.seed + len(plants)
+                plants.append(plant_globals)
+        return plants
+
+    def run(self):
+        plants = self.configurations()
+        classes = serialized_classes()
+        metadata = list(self.metadata)
+        output_fileset = self.output().get()
+        n_workers = self.n_workers if self.n_workers > 0 else None
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            x = self.input().get().get_file(self.lpy_file_id)
+            lpy_filename = os.path.join(tmpdir, "f.lpy")
+            with open(lpy_filename, "wb") as f:
+                f.write(x.read_raw())
+
+            jobs = [("plant_%05d"%i, g, tmpdir, classes, metadata)
+                    for i, g in enumerate(plants)]
+            plant_globals = {job[0]: job[1] for job in jobs}
+
+            with multiprocessing.Pool(n_workers, initializer=_init_batch_worker,
+                                      initargs=(lpy_filename,)) as pool:
+                for name, fname, values in pool.imap_unordered(_generate_batch_plant, jobs):
+                    logger.debug("generated %s"%name)
+                    output_file = output_fileset.create_file(name)
+                    output_file.import_file(fname)
+                    mtl_fname = os.path.splitext(fname)[0] + ".mtl"
+                    output_mtl_file = output_fileset.create_file(name + "_mtl")
+                    output_mtl_file.import_file(mtl_fname)
+                    output_file.set_metadata({**values, "lpy_globals": plant_globals[name]})
+                    os.remove(fname)
+                    os.remove(mtl_fname)
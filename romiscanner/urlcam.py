@@ -22,13 +22,89 @@
     <https://www.gnu.org/licenses/>.
 
 """
-# import urllib
-# import cv2
+import collections
+import threading
+import time
 
-import imageio
 import requests
+import urllib3
 
 from . import hal
+from .log import logger
+
+MAX_FRAME_SIZE = 16 * 1024**2  # bytes read for a single part of the MJPEG stream
+MAX_LINE_SIZE = 64 * 1024
+
+
+def multipart_boundary(content_type: str) -> bytes:
+    """Boundary of a multipart content type"""
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary":
+            boundary = value.strip('"')
+            if boundary.startswith("--"):  # Some servers include the dashes
+                boundary = boundary[2:]
+            return boundary.encode()
+    raise ValueError("No multipart boundary in content type: %s" % content_type)
+
+
+def iter_parts(stream, boundary: bytes):
+    """
+    Yields the bodies of the parts of a multipart stream. The body size is
+    given by the Content-Length header of the part if present, otherwise the
+    body goes up to the next boundary. Parts larger than MAX_FRAME_SIZE
+    raise a ValueError.
+    """
+    delimiter = b"--" + boundary
+
+    def readline():
+        line = stream.readline(MAX_LINE_SIZE)
+        if not line:
+            raise ValueError("MJPEG stream closed")
+        return line
+
+    def is_delimiter(line):
+        return line.strip() in (delimiter, delimiter + b"--")
+
+    def skip_to_delimiter():
+        size = 0
+        line = readline()
+        while not is_delimiter(line):
+            size += len(line)
+            if size > MAX_FRAME_SIZE:
+                raise ValueError("No multipart boundary in the MJPEG stream")
+            line = readline()
+
+    skip_to_delimiter()
+    while True:
+        headers = {}
+        line = readline()
+        while line.strip() != b"":
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+            line = readline()
+
+        if "content-length" in headers:
+            length = int(headers["content-length"])
+            if length > MAX_FRAME_SIZE:
+                raise ValueError("MJPEG frame too large: %i bytes" % length)
+            data = b""
+            while len(data) < length:
+                x = stream.read(length - len(data))
+                if not x:
+                    raise ValueError("MJPEG stream closed")
+                data += x
+            yield data
+            skip_to_delimiter()
+        else:
+            data = b""
+            line = readline()
+            while not is_delimiter(line):
+                data += line
+                if len(data) > MAX_FRAME_SIZE:
+                    raise ValueError("MJPEG frame too large")
+                line = readline()
+            yield data.rstrip(b"\r\n")
 
 
 class Camera(hal.AbstractCamera):
@@ -36,6 +112,14 @@ class Camera(hal.AbstractCamera):
 
     Image is served as `$url/scan.jpg`.
 
+    With `mode="request"` (default), each grab downloads a new picture. With
+    `mode="poll"`, a background thread keeps downloading `$url/scan.jpg` over
+    a persistent session, and with `mode="mjpeg"` it reads the MJPEG stream
+    served at `$url + stream_path`. In both cases the latest JPEG frames are
+    kept, with the time they were requested, in a ring buffer and grab
+    returns the first frame taken after it was called, without a request
+    round trip.
+
     Examples
     --------
     >>> from romiscanner.urlcam import Camera
@@ -47,21 +131,95 @@ class Camera(hal.AbstractCamera):
 
     """
 
-    def __init__(self, url):
+    def __init__(self, url, mode: str = "request", stream_path: str = "/stream.mjpg",
+                 buffer_size: int = 8, timeout: float = 10.):
+        if mode not in ["request", "poll", "mjpeg"]:
+            raise ValueError("Unknown mode: %s" % mode)
         self.url = url
+        self.mode = mode
+        self.stream_path = stream_path
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.frames = collections.deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        if mode != "request":
+            self.start()
+
+    def start(self):
+        self.running = True
+        target = self.poll if self.mode == "poll" else self.read_stream
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def add_frame(self, timestamp, frame):
+        with self.condition:
+            self.frames.append((timestamp, frame))
+            self.condition.notify_all()
+
+    def poll(self):
+        while self.running:
+            t = time.time()
+            try:
+                r = self.session.get(self.url + "/scan.jpg", timeout=self.timeout)
+                r.raise_for_status()
+            except requests.RequestException as e:
+                logger.warning("urlcam: %s" % e)
+                time.sleep(1)
+                continue
+            self.add_frame(t, r.content)
+
+    def read_stream(self):
+        while self.running:
+            try:
+                with self.session.get(self.url + self.stream_path, stream=True,
+                                      timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    boundary = multipart_boundary(r.headers.get("Content-Type", ""))
+                    for frame in iter_parts(r.raw, boundary):
+                        if not self.running:
+                            return
+                        self.add_frame(time.time(), frame)
+            except (requests.RequestException, urllib3.exceptions.HTTPError,
+                    OSError, ValueError) as e:
+                logger.warning("urlcam: %s" % e)
+                time.sleep(1)
+
+    def get_frame(self, after: float = 0):
+        """Returns the first JPEG frame of the buffer taken after the given time,
+        and its timestamp."""
+        def first_after():
+            for t, frame in self.frames:
+                if t > after:
+                    return t, frame
+            return None
+        with self.condition:
+            res = self.condition.wait_for(first_after, self.timeout)
+        if res is None:
+            raise TimeoutError("No frame received from %s" % self.url)
+        t, frame = res
+        return frame, t
+
+    def grab_bytes(self) -> bytes:
+        """Returns a JPEG picture taken after the call"""
+        if self.mode == "request":
+            r = self.session.get(self.url + "/scan.jpg", timeout=self.timeout)
+            r.raise_for_status()
+            return r.content
+        frame, _ = self.get_frame(after=time.time())
+        return frame
 
     def channels(self):
         return ["rgb"]
 
     def grab(self, idx: int, metadata: dict = None):
         data_item = hal.DataItem(idx, metadata)
-        # https://docs.python.org/3/library/http.server.html#http.server.BaseHTTPRequestHandler.wfile
-        # wfile:
-        #   Contains the output stream for writing a response back to the client.
-        #   Proper adherence to the HTTP protocol must be used when writing to this stream in order to achieve successful interoperation with HTTP clients.
-        #   Changed in version 3.6: This is an io.BufferedIOBase stream.
-        # data = imageio.imread(BytesIO(requests.get(self.url+"scan.jpg").content))
-        # _ = requests.get(self.url + "/scan.jpg")  # update the picture
-        data = imageio.imread(self.url + "/scan.jpg")  # download it
-        data_item.add_channel(self.channels()[0], data)
+        data_item.add_channel(self.channels()[0], encoded=self.grab_bytes(), fmt="jpg")
         return data_item
@@ -9,16 +9,19 @@ import atexit
 import time
 import requests
 import imageio
+import base64
 from io import BytesIO
 import numpy as np
 from typing import List
 import tempfile
+import hashlib
 
 from romidata.db import Fileset, File
 
 from romiscanner.hal import DataItem, AbstractScanner
 from romiscanner import path
 from romidata import io
+from .cache import RenderCache
 from .log import logger
 
 
@@ -39,6 +42,12 @@ def check_port(port: str):
         return False
     return True
 
+def file_hash(f) -> str:
+    """sha256 of an open file, which is rewound afterwards"""
+    h = hashlib.sha256(f.read()).hexdigest()
+    f.seek(0)
+    return h
+
 class VirtualScannerRunner():
     """
     A class for running blender in the background for the virtual scanner. It initalizes the flask server
@@ -93,8 +102,27 @@ class VirtualScanner(AbstractScanner):
                        port: int= 5000, # port, useful only if host is set
                        scene: str=None,
                        add_leaf_displacement: bool=False,
-                       classes: List[str]=[]): # list of classes to render
+                       classes: List[str]=[], # list of classes to render
+                       n_variants: int=0, # number of appearance variants rendered at each pose
+                       seed: int=None, # seed of the renderer randomization, shot idx is added for each shot
+                       render_cache: bool=False, # serve shots already rendered from a local cache (needs a seed)
+                       render_cache_dir: str=None, # cache location, see cache.default_cache_dir
+                       render_cache_size: float=10., # maximum size of the cache, in GB
+                       spill_dir: str=None): # memory map the decoded channels to this directory
         super().__init__()
+        self.spill_dir = spill_dir
+
+        self.render_cache = None
+        if render_cache and seed is None:
+            # Renders are random without a seed, they cannot be reused
+            logger.warning("The render cache needs a seed, renders are not cached")
+        elif render_cache:
+            self.render_cache = RenderCache(render_cache_dir, int(render_cache_size * 1024**3))
+        self.seed = seed
+        self.pose_sent = True
+        self.asset_hashes = {}
+        if scene is not None:
+            self.asset_hashes["scene"] = scene
 
         if host == None:
             self.runner = VirtualScannerRunner(scene=scene)
@@ -110,6 +138,9 @@ class VirtualScanner(AbstractScanner):
         self.classes = classes
 
         self.flash = flash
+        self.n_variants = n_variants
+        if self.runner is None and scene is not None:
+            self.load_scene(scene)
         self.set_intrinsics(width, height, focal)
         self.id = 0
         self.ext = "png"
@@ -121,6 +152,15 @@ class VirtualScanner(AbstractScanner):
         return self.position
 
     def set_position(self, pose: path.Pose) -> None:
+        self.position = pose
+        if self.render_cache is not None:
+            # Sent before rendering, cache hits do not need it
+            self.pose_sent = False
+        else:
+            self.send_position()
+
+    def send_position(self) -> None:
+        pose = self.position
         data = {
             "rx": 90 - pose.tilt,
             "rz": pose.pan,
@@ -129,7 +169,7 @@ class VirtualScanner(AbstractScanner):
             "tz": pose.z
         }
         self.request_post("camera_pose", data)
-        self.position = pose
+        self.pose_sent = True
 
     def set_intrinsics(self, width: int, height: int, focal: float) -> None:
         self.width = width
@@ -142,6 +182,19 @@ class VirtualScanner(AbstractScanner):
         }
         self.request_post("camera_intrinsics", data)
 
+    def load_scene(self, scene: str) -> None:
+        """
+        Loads a blender scene, given as a path on the server host. The server
+        keeps the scene open, loading it again only reverts it to its
+        original objects. This only saves the loading of the scene with a
+        server given by its host: a virtual scanner launched by the scanner
+        opens the scene when it starts (--scene), and stops with the scanner.
+        """
+        self.request_post("load_scene", {"path": scene})
+        self.asset_hashes = {"scene": scene}
+        if hasattr(self, "width"): # intrinsics are reset by a new scene
+            self.set_intrinsics(self.width, self.height, self.focal)
+
     def list_objects(self):
         return self.request_get_dict("objects")
 
@@ -171,7 +224,15 @@ class VirtualScanner(AbstractScanner):
                 palette_file_path = os.path.join(tmpdir, palette.filename)
                 io.to_file(palette, palette_file_path)
                 files["palette"] = open(palette_file_path, "rb")
-            res = self.request_post("upload_object", {"colorize" : colorize}, files)
+            data = {"colorize" : colorize}
+            if self.seed is not None:
+                data["seed"] = self.seed
+            for k in ["file", "mtl", "palette"]:
+                self.asset_hashes.pop(k, None)
+            for k in files:
+                self.asset_hashes[k] = file_hash(files[k])
+            self.asset_hashes["colorize"] = colorize
+            res = self.request_post("upload_object", data, files)
         if self.add_leaf_displacement:
             self.request_get_dict("add_random_displacement/leaf")
         return res
@@ -185,6 +246,7 @@ class VirtualScanner(AbstractScanner):
             file_path = os.path.join(tmpdir, file.filename)
             io.to_file(file, file_path)
             files = { "file" : open(file_path, "rb")}
+            self.asset_hashes["background"] = file_hash(files["file"])
             return self.request_post("upload_background", {}, files)
 
     def request_get_bytes(self, endpoint: str) -> bytes:
@@ -202,50 +264,132 @@ class VirtualScanner(AbstractScanner):
         if x.status_code != 200:
             raise Exception("Virtual scanner returned an error (error code %i)"%x.status_code)
 
+    def variant_channels(self):
+        return ['rgb_variant_%i'%i for i in range(self.n_variants)]
+
     def channels(self):
         if self.classes == []:
-            return ['rgb']
+            return ['rgb'] + self.variant_channels()
         else:
-            return ['rgb'] + self.classes + ['background']
+            return ['rgb'] + self.variant_channels() + self.classes + ['background']
 
     def get_bounding_box(self):
         return self.request_get_dict("bounding_box")
 
-    def grab(self, idx: int, metadata: dict=None) -> DataItem:
+    def render_state(self, idx: int) -> dict:
+        """Everything a rendered shot depends on, used as render cache key"""
+        pose = self.position
+        return {
+            "assets": self.asset_hashes,
+            "intrinsics": [self.width, self.height, self.focal],
+            "pose": [pose.x, pose.y, pose.z, pose.pan, pose.tilt],
+            "flash": self.flash,
+            "leaf_displacement": self.add_leaf_displacement,
+            "channels": self.channels(),
+            "seed": self.shot_seed(idx)
+        }
+
+    def shot_seed(self, idx: int):
+        if self.seed is None:
+            return None
+        return self.seed + idx
 
-        data_item = DataItem(idx, metadata)
+    def render_shot(self, idx: int):
+        """
+        Renders all the channels of a shot. Returns the encoded images of
+        each channel, except background, and the shot metadata.
+        """
+        if not self.pose_sent:
+            self.send_position()
+        seed = self.shot_seed(idx)
+        images = {}
+        metadata = {}
         for c in self.channels():
-            if c != 'background':
-                data_item.add_channel(c, self.render(channel=c))
-            else:
-                x = np.zeros(data_item.channel(self.classes[0]).data.shape)
-                for c in self.classes:
-                    x = np.maximum(x, data_item.channel(c).data)
-                x = 1.0 - x
-                data_item.add_channel("background", x)
-                
+            if c == 'rgb' or c in self.classes:
+                images[c] = self.render_bytes(channel=c, seed=seed)
+        if self.n_variants > 0:
+            variants = self.render_variants_bytes(seed=seed)
+            for c, (params, data) in zip(self.variant_channels(), variants):
+                images[c] = data
+            metadata["variants"] = [params for params, _ in variants]
+
         rt = self.request_get_dict("camera_pose")
         k = self.request_get_dict("camera_intrinsics")
 
-        if metadata is None:
-            metadata = {}
-
         metadata["camera"] = {
             "camera_model" : k,
             **rt
         }
+        return images, metadata
+
+    def grab(self, idx: int, metadata: dict=None) -> DataItem:
+        if metadata is None:
+            metadata = {}
+
+        cached = None
+        if self.render_cache is not None:
+            key = self.render_cache.key(self.render_state(idx))
+            cached = self.render_cache.get(key)
+        if cached is not None:
+            images, shot_metadata = cached
+        else:
+            images, shot_metadata = self.render_shot(idx)
+            if self.render_cache is not None:
+                self.render_cache.put(key, images, shot_metadata)
+        metadata.update(shot_metadata)
+
+        data_item = DataItem(idx, metadata, spill_dir=self.spill_dir)
+        for c in self.channels():
+            if c in self.classes:
+                data_item.add_channel(c, imageio.imread(BytesIO(images[c]))[:,:,3])
+            elif c != 'background':
+                data_item.add_channel(c, encoded=images[c], fmt="png")
+            else:
+                shape = data_item.channel(self.classes[0]).data.shape
+                x = data_item.allocate_channel("background", shape, dtype=float)
+                for c in self.classes:
+                    np.maximum(x, data_item.channel(c).data, out=x)
+                np.subtract(1.0, x, out=x)
         return data_item
-                
-    def render(self, channel='rgb'):
+
+    def render_bytes(self, channel='rgb', seed=None) -> bytes:
+        """Renders a channel, returns the PNG image"""
         if channel == 'rgb':
             ep = "render"
+            args = []
             if self.flash:
-                ep = ep+"?flash=1"
-            x = self.request_get_bytes(ep)
-            data = imageio.imread(BytesIO(x))
-            return data
+                args.append("flash=1")
+            if seed is not None:
+                args.append("seed=%i"%seed)
+            if len(args) > 0:
+                ep = ep+"?"+"&".join(args)
+            return self.request_get_bytes(ep)
         else:
-            x = self.request_get_bytes("render_class/%s"%channel)
-            data = imageio.imread(BytesIO(x))
+            return self.request_get_bytes("render_class/%s"%channel)
+
+    def render(self, channel='rgb'):
+        data = imageio.imread(BytesIO(self.render_bytes(channel)))
+        if channel != 'rgb':
             data = data[:,:,3]
-            return data
+        return data
+
+    def render_variants_bytes(self, seed=None):
+        """
+        Renders the appearance variants of the current view in one request.
+        Returns a list of (parameters, PNG image) tuples.
+        """
+        ep = "render_variants?n=%i"%self.n_variants
+        if self.flash:
+            ep = ep+"&flash=1"
+        if seed is not None:
+            ep = ep+"&seed=%i"%seed
+        res = self.request_get_dict(ep)
+        return [(v["params"], base64.b64decode(v["image"])) for v in res["variants"]]
+
+    def render_variants(self):
+        """
+        Renders the appearance variants of the current view in one request.
+        Returns a list of (parameters, image) tuples.
+        """
+        return [(params, imageio.imread(BytesIO(x)))
+                for params, x in self.render_variants_bytes()]
@@ -11,7 +11,8 @@ s = setup(
         'bin/romi_bpy',
         'bin/romi_virtualscanner',
         'bin/romi_split_by_material',
-        'bin/romi_clean_mesh'
+        'bin/romi_clean_mesh',
+        'bin/romi_raster_validate'
     ],
     author='Timothée Wintz',
     author_email='timothee@timwin.fr',